@@ -1,25 +1,65 @@
 from datetime import datetime
 from django import forms
+from django.conf.urls import url
+from django.core.exceptions import PermissionDenied
 from django.db import models
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.safestring import mark_safe
 
+from csvimport.jobs import enqueue
 from csvimport.models import CSVImport
 
+# Poll the progress of a queued or running import and reload the page when it finishes
+PROGRESS_HTML = """<span id="csvimport-progress">%s - %s rows</span>
+<script>
+(function () {
+    var poll = setInterval(function () {
+        fetch("../progress/", {credentials: "same-origin"}).then(function (response) {
+            return response.json();
+        }).then(function (job) {
+            document.getElementById("csvimport-progress").textContent =
+                job.status + " - " + job.progress + " rows";
+            if (job.status == "done" || job.status == "failed") {
+                clearInterval(poll);
+                window.location.reload();
+            }
+        });
+    }, 2000);
+})();
+</script>"""
+
 
 class CSVImportAdmin(ModelAdmin):
     ''' Custom model to not have much editable! '''
     readonly_fields = ['file_name',
                        'upload_method',
                        'error_log_html',
-                       'import_user']
+                       'import_user',
+                       'progress_html',
+                       'queued_at',
+                       'started_at',
+                       'finished_at',
+                       'wait_seconds',
+                       'run_seconds']
     fields = [
         'model_name',
         'field_list',
         'upload_file',
         'file_name',
         'encoding',
+        'conflict_keys',
+        'update_fields',
+        'priority',
         'upload_method',
+        'progress_html',
+        'queued_at',
+        'started_at',
+        'finished_at',
+        'wait_seconds',
+        'run_seconds',
         'error_log_html',
         'import_user']
     formfield_overrides = {
@@ -27,28 +67,43 @@ class CSVImportAdmin(ModelAdmin):
                                                            'cols': '60'})},
     }
 
+    list_display = ['file_name', 'model_name', 'status', 'progress', 'priority',
+                    'wait_seconds', 'run_seconds', 'import_date']
+
     def save_model(self, request, obj, form, change):
-        """ Do save and process command - cant commit False
+        """ Do save and queue the import - cant commit False
             since then file wont be found for reopening via right charset
         """
         form.save()
-        from csvimport.management.commands.importcsv import Command
-        cmd = Command()
         if obj.upload_file:
             obj.file_name = obj.upload_file.name
             obj.encoding = ''
-            defaults = self.filename_defaults(obj.file_name)
-            cmd.setup(mappings=obj.field_list,
-                      modelname=obj.model_name,
-                      charset=obj.encoding,
-                      uploaded=obj.upload_file,
-                      defaults=defaults)
-        errors = cmd.run(logid=obj.id)
-        if errors:
-            obj.error_log = '\n'.join(errors)
         obj.import_user = str(request.user)
         obj.import_date = datetime.now()
-        obj.save()
+        enqueue(obj)
+
+    def get_urls(self):
+        urls = [
+            url(r'^(.+)/progress/$',
+                self.admin_site.admin_view(self.progress_view),
+                name='csvimport_csvimport_progress'),
+        ]
+        return urls + super(CSVImportAdmin, self).get_urls()
+
+    def progress_view(self, request, object_id):
+        """ Status and progress of the import for the change page to poll """
+        obj = get_object_or_404(CSVImport, pk=object_id)
+        if not self.has_change_permission(request, obj):
+            raise PermissionDenied
+        return JsonResponse({'status': obj.status,
+                             'progress': obj.progress,
+                             'error_log': obj.error_log})
+
+    def progress_html(self, obj):
+        if obj.status in ('queued', 'running'):
+            return mark_safe(PROGRESS_HTML % (obj.status, obj.progress))
+        return '%s - %s rows' % (obj.status, obj.progress)
+    progress_html.short_description = 'Progress'
 
     def filename_defaults(self, filename):
         """ Override this method to supply filename based data """
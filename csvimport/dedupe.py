@@ -0,0 +1,110 @@
+""" Indexes of row keys for deduplicating imports, of the keys already in a table
+    so large tables need no query per row or chunk, and of the rows seen in the file
+"""
+import hashlib
+import math
+import sqlite3
+
+MIN_CAPACITY = 100000
+
+
+class KeyIndex(object):
+    """ Set of the key values, as tuples of the model fields python types.
+        The keys themselves are kept, not their hashes, so hits need no confirming
+    """
+
+    confirm = False
+
+    def __init__(self, capacity=MIN_CAPACITY, error_rate=0):
+        self.keys = set()
+
+    def add(self, key):
+        self.keys.add(key)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class BloomFilter(object):
+    """ Bloom filter of the key values sized for capacity keys at the error rate.
+        Hits may be false positives so they should be confirmed against the database
+    """
+
+    confirm = True
+
+    def __init__(self, capacity=MIN_CAPACITY, error_rate=0.001):
+        capacity = max(capacity, MIN_CAPACITY)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """ Bit positions for a key by double hashing its md5 digest """
+        digest = hashlib.md5(repr(key).encode("utf-8")).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+DEDUPE_INDEXES = {"set": KeyIndex, "bloom": BloomFilter}
+
+
+class SpillSet(object):
+    """ Set of key digests for finding repeated rows that holds up to limit digests in memory,
+        then moves them to a temporary sqlite database on disk so memory use stays bounded.
+        The 128 bit md5 digests of distinct keys are not expected to collide, unlike the builtin hash
+    """
+
+    def __init__(self, limit=100000):
+        self.limit = limit
+        self.hashes = set()
+        self.db = None
+
+    def add(self, key):
+        """ Add a key, returning False if it was already in the set """
+        value = hashlib.md5(repr(key).encode("utf-8")).digest()
+        if value in self.hashes:
+            return False
+        if self.db is not None:
+            found = self.db.execute("SELECT 1 FROM seen WHERE hash = ?", (sqlite3.Binary(value),))
+            if found.fetchone():
+                return False
+        self.hashes.add(value)
+        if len(self.hashes) >= self.limit:
+            self.spill()
+        return True
+
+    def spill(self):
+        """ Move the digests in memory to disk """
+        if self.db is None:
+            # An empty name is a private temporary file deleted on close
+            self.db = sqlite3.connect("")
+            self.db.execute("CREATE TABLE seen (hash BLOB PRIMARY KEY)")
+        self.db.executemany(
+            "INSERT OR IGNORE INTO seen VALUES (?)",
+            ((sqlite3.Binary(value),) for value in self.hashes),
+        )
+        self.hashes = set()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        self.hashes = set()
@@ -0,0 +1,225 @@
+""" Database specific engines for bulk loading rows of column values
+    straight into a table rather than with the ORM bulk create
+"""
+import io
+import sqlite3
+from contextlib import contextmanager
+
+from django.db import connections, models, router, transaction
+
+ENGINES = ["orm", "insert", "copy", "sqlite"]
+
+
+class Engine(object):
+    """ Base engine that loads tuples of the values of a models concrete fields,
+        excluding an auto primary key, in the order of self.fields
+    """
+
+    vendor = ""
+    upserts = False
+
+    def __init__(self, model):
+        self.model = model
+        self.connection = connections[router.db_for_write(model)]
+        self.fields = [
+            field
+            for field in model._meta.local_concrete_fields
+            if not isinstance(field, models.AutoField)
+        ]
+        self.table = self.quote(model._meta.db_table)
+        self.columns = ", ".join([self.quote(field.column) for field in self.fields])
+
+    def supported(self):
+        return self.connection.vendor == self.vendor
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def model_values(self, model):
+        """ Tuple of a model instance's values ready for the database """
+        return tuple(
+            field.get_db_prep_save(field.pre_save(model, True), self.connection)
+            for field in self.fields
+        )
+
+    @contextmanager
+    def load(self):
+        """ Context for the whole import """
+        yield
+
+    def write(self, rows):
+        """ Insert the rows """
+        raise NotImplementedError
+
+    def upsert(self, rows, conflict_fields, update_fields):
+        """ Insert the rows, updating the update fields of those whose conflict fields exist """
+        raise NotImplementedError
+
+    def on_conflict(self, conflict_fields, update_fields):
+        """ ON CONFLICT clause for upserts """
+        if update_fields:
+            action = "UPDATE SET %s" % ", ".join(
+                ["%s = EXCLUDED.%s" % ((self.quote(field.column),) * 2) for field in update_fields]
+            )
+        else:
+            action = "NOTHING"
+        return "ON CONFLICT (%s) DO %s" % (
+            ", ".join([self.quote(field.column) for field in conflict_fields]),
+            action,
+        )
+
+
+class InsertEngine(Engine):
+    """ Engine for any database that inserts rows with the backends multi row INSERT,
+        in batches of the most rows its query parameter limit allows
+    """
+
+    def supported(self):
+        return True
+
+    def write(self, rows):
+        ops = self.connection.ops
+        size = max(1, ops.bulk_batch_size(self.fields, rows) or len(rows))
+        placeholders = ["%s"] * len(self.fields)
+        with self.connection.cursor() as cursor:
+            for start in range(0, len(rows), size):
+                batch = rows[start : start + size]
+                cursor.execute(
+                    "INSERT INTO %s (%s) %s"
+                    % (
+                        self.table,
+                        self.columns,
+                        ops.bulk_insert_sql(self.fields, [placeholders] * len(batch)),
+                    ),
+                    [value for row in batch for value in row],
+                )
+
+
+def copy_text(value):
+    """ Value in the PostgreSQL COPY text format """
+    if value is None:
+        return "\\N"
+    if value is True or value is False:
+        return "t" if value else "f"
+    value = str(value)
+    for char, escaped in (("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")):
+        value = value.replace(char, escaped)
+    return value
+
+
+class CopyEngine(Engine):
+    """ PostgreSQL engine that streams rows into the table with COPY FROM STDIN,
+        or for upserts into a temporary staging table merged in with INSERT ON CONFLICT
+    """
+
+    vendor = "postgresql"
+    upserts = True
+
+    def write(self, rows):
+        self.copy(self.table, rows)
+
+    def upsert(self, rows, conflict_fields, update_fields):
+        stage = self.quote("csvimport_stage")
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (stage, self.table)
+            )
+            self.copy(stage, rows)
+            cursor.execute(
+                "INSERT INTO %s (%s) SELECT %s FROM %s %s"
+                % (
+                    self.table,
+                    self.columns,
+                    self.columns,
+                    stage,
+                    self.on_conflict(conflict_fields, update_fields),
+                )
+            )
+            cursor.execute("DROP TABLE %s" % stage)
+
+    def copy(self, table, rows):
+        """ COPY the rows into a table via psycopg2 copy_expert or psycopg 3 copy """
+        data = io.StringIO()
+        for row in rows:
+            data.write(u"\t".join([copy_text(value) for value in row]) + u"\n")
+        sql = "COPY %s (%s) FROM STDIN" % (table, self.columns)
+        with self.connection.cursor() as cursor:
+            with self.connection.wrap_database_errors:
+                if hasattr(cursor.cursor, "copy_expert"):
+                    data.seek(0)
+                    cursor.cursor.copy_expert(sql, data)
+                else:
+                    with cursor.cursor.copy(sql) as copy:
+                        copy.write(data.getvalue())
+
+
+class SqliteEngine(Engine):
+    """ SQLite engine that inserts rows with one prepared INSERT run by executemany,
+        with the whole import in one transaction and the pragmas set for loading speed
+    """
+
+    vendor = "sqlite"
+    # Import scoped pragma values, restored afterwards
+    pragmas = (("journal_mode", "MEMORY"), ("synchronous", "OFF"), ("cache_size", "-65536"))
+    # Upsert syntax was added in SQLite 3.24
+    upserts = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+    @contextmanager
+    def load(self):
+        restore = []
+        # Pragmas cannot change the journal or safety level inside a transaction
+        if not self.connection.in_atomic_block:
+            with self.connection.cursor() as cursor:
+                for pragma, value in self.pragmas:
+                    cursor.execute("PRAGMA %s" % pragma)
+                    restore.append((pragma, cursor.fetchone()[0]))
+                    cursor.execute("PRAGMA %s = %s" % (pragma, value))
+        try:
+            with transaction.atomic(using=self.connection.alias):
+                yield
+        finally:
+            if restore:
+                with self.connection.cursor() as cursor:
+                    for pragma, value in restore:
+                        cursor.execute("PRAGMA %s = %s" % (pragma, value))
+
+    def insert_sql(self):
+        return "INSERT INTO %s (%s) VALUES (%s)" % (
+            self.table,
+            self.columns,
+            ", ".join(["%s"] * len(self.fields)),
+        )
+
+    def write(self, rows):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(self.insert_sql(), rows)
+
+    def upsert(self, rows, conflict_fields, update_fields):
+        sql = "%s %s" % (self.insert_sql(), self.on_conflict(conflict_fields, update_fields))
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+
+ENGINE_CLASSES = {"insert": InsertEngine, "copy": CopyEngine, "sqlite": SqliteEngine}
+
+
+@contextmanager
+def loading(engine):
+    """ Context for the whole import, that of the engine if there is one """
+    if engine is None:
+        yield
+    else:
+        with engine.load():
+            yield
+
+
+def get_engine(name, model):
+    """ Get the named engine for a model, or None if it is the ORM
+        or the engine does not support the database
+    """
+    engine_class = ENGINE_CLASSES.get(name)
+    if engine_class:
+        engine = engine_class(model)
+        if engine.supported():
+            return engine
+    return None
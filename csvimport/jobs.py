@@ -0,0 +1,497 @@
+""" Queue of import jobs kept on the CSVImport records, so imports saved in the admin
+    run in a csvimport_worker process, or a thread pool for small deployments,
+    rather than in the web request.
+    Jobs are scheduled by priority then fairly between sources, within the limits
+    on how many imports run in all and into each model.
+    The file of a job can be split into chunks leased by workers on several hosts
+"""
+import codecs
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.contrib import admin
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from csvimport.models import CSVImport, ImportChunk, ImportLock
+
+# worker to leave jobs for csvimport_worker, thread to run them in a thread pool
+# or sync to run them in the request
+CSVIMPORT_QUEUE = getattr(settings, "CSVIMPORT_QUEUE", "thread")
+CSVIMPORT_THREADS = getattr(settings, "CSVIMPORT_THREADS", 2)
+# Most imports running at once from all sources, and into each model, 0 for no limit
+CSVIMPORT_MAX_IMPORTS = getattr(settings, "CSVIMPORT_MAX_IMPORTS", 0)
+CSVIMPORT_MODEL_LIMIT = getattr(settings, "CSVIMPORT_MODEL_LIMIT", 0)
+# Limits for particular models, eg. {"app_label.model_name": 1}
+CSVIMPORT_MODEL_LIMITS = getattr(settings, "CSVIMPORT_MODEL_LIMITS", {})
+# Seconds after which a lock is treated as abandoned by a dead process
+CSVIMPORT_LOCK_TIMEOUT = getattr(settings, "CSVIMPORT_LOCK_TIMEOUT", 24 * 3600)
+# Seconds a worker has to import a chunk before it is leased to another, and the
+# number of times a chunk that fails is retried
+CSVIMPORT_LEASE_SECONDS = getattr(settings, "CSVIMPORT_LEASE_SECONDS", 600)
+CSVIMPORT_CHUNK_ATTEMPTS = getattr(settings, "CSVIMPORT_CHUNK_ATTEMPTS", 3)
+executor = None
+
+
+def enqueue(job, start=True):
+    """ Save the job as queued and start it if there is no worker process """
+    job.status = "queued"
+    job.progress = 0
+    job.queued_at = timezone.now()
+    job.started_at = None
+    job.finished_at = None
+    job.wait_seconds = None
+    job.run_seconds = None
+    job.save()
+    if not start:
+        return job
+    if CSVIMPORT_QUEUE == "sync":
+        job = claim_job(job.id)
+        if job:
+            run_job(job)
+    elif CSVIMPORT_QUEUE == "thread":
+        # The admin saves in a transaction, the thread must not look for the job before it commits
+        transaction.on_commit(submit_queued)
+    return job
+
+
+def submit_queued():
+    """ Run the queued jobs in the thread pool """
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(CSVIMPORT_THREADS)
+    executor.submit(run_queued)
+
+
+def claim_job(jobid=None):
+    """ Claim the next queued job that has free import slots, or the job of jobid,
+        and mark it running. The update only matches a job that is still queued
+        so it is never claimed twice
+    """
+    jobs = CSVImport.objects.filter(status="queued", chunks=0)
+    if jobid:
+        jobs = jobs.filter(id=jobid)
+    for job in fair_order(jobs.order_by("-priority", "queued_at", "id")[:100]):
+        locks = acquire_slots(job.model_name)
+        if locks is None:
+            continue
+        now = timezone.now()
+        wait = (now - job.queued_at).total_seconds() if job.queued_at else None
+        if CSVImport.objects.filter(id=job.id, status="queued").update(
+            status="running", started_at=now, wait_seconds=wait
+        ):
+            ImportLock.objects.filter(id__in=[lock.id for lock in locks]).update(csvimport=job)
+            job.status = "running"
+            job.started_at = now
+            job.wait_seconds = wait
+            return job
+        release_slots(locks)
+    return None
+
+
+def fair_order(jobs):
+    """ Order jobs by priority, then take them in turn from each source, upload method,
+        starting with the source with fewest imports running, so one busy source
+        cannot starve the others
+    """
+    running = dict(
+        CSVImport.objects.filter(status="running")
+        .values_list("upload_method")
+        .annotate(Count("id"))
+    )
+    levels = OrderedDict()
+    for job in jobs:
+        levels.setdefault(job.priority, OrderedDict()).setdefault(job.upload_method, []).append(job)
+    ordered = []
+    for sources in levels.values():
+        queues = sorted(sources.values(), key=lambda queue: running.get(queue[0].upload_method, 0))
+        while queues:
+            for queue in queues:
+                ordered.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def slot_names(model_name):
+    """ Lock names of the import slots, a slot from each list is needed to import into a model """
+    groups = []
+    if CSVIMPORT_MAX_IMPORTS:
+        groups.append(["*:%s" % slot for slot in range(CSVIMPORT_MAX_IMPORTS)])
+    limit = CSVIMPORT_MODEL_LIMITS.get(model_name, CSVIMPORT_MODEL_LIMIT)
+    if limit:
+        groups.append(["%s:%s" % (model_name, slot) for slot in range(limit)])
+    return groups
+
+
+def acquire_slots(model_name):
+    """ Lock a free slot from each group, or return None if a group is full """
+    break_stale_locks()
+    locks = []
+    for names in slot_names(model_name):
+        for name in names:
+            try:
+                with transaction.atomic():
+                    locks.append(ImportLock.objects.create(name=name))
+                break
+            except IntegrityError:
+                pass
+        else:
+            release_slots(locks)
+            return None
+    return locks
+
+
+def release_slots(locks):
+    ImportLock.objects.filter(id__in=[lock.id for lock in locks]).delete()
+
+
+def break_stale_locks():
+    """ Release the locks of jobs that are no longer running, of chunks whose lease has
+        run out and any held past the timeout
+    """
+    ImportLock.objects.exclude(csvimport=None).exclude(csvimport__status="running").delete()
+    ImportLock.objects.filter(expires_at__lt=timezone.now()).delete()
+    if CSVIMPORT_LOCK_TIMEOUT:
+        ImportLock.objects.filter(
+            locked_at__lt=timezone.now() - timedelta(seconds=CSVIMPORT_LOCK_TIMEOUT)
+        ).delete()
+
+
+@contextmanager
+def import_slots(model_name, sleep=5.0):
+    """ Hold import slots for an import run outside the queue, waiting for them to be free """
+    locks = acquire_slots(model_name)
+    while locks is None:
+        time.sleep(sleep)
+        locks = acquire_slots(model_name)
+    try:
+        yield locks
+    finally:
+        release_slots(locks)
+
+
+def report_progress(job, rows):
+    job.progress = rows
+    CSVImport.objects.filter(id=job.id).update(progress=rows)
+
+
+def setup_job(cmd, job, stream=False):
+    """ Setup the command to import the file of a job with the options it was queued with """
+    # Defaults from the file name, if the admin is registered with a filename_defaults
+    modeladmin = admin.site._registry.get(CSVImport)
+    if job.upload_file:
+        uploaded, csvfile = job.upload_file, ""
+    else:
+        uploaded, csvfile = None, job.file_name
+    defaults = job.defaults
+    if not defaults and modeladmin:
+        defaults = modeladmin.filename_defaults(job.file_name)
+    return cmd.setup(
+        mappings=job.field_list,
+        modelname=job.model_name,
+        charset=job.encoding,
+        csvfile=csvfile,
+        uploaded=uploaded,
+        defaults=defaults,
+        upsert=bool(job.conflict_keys),
+        conflict_keys=job.conflict_keys,
+        update_fields=job.update_fields,
+        dedupe_keys=job.dedupe_keys,
+        engine=job.engine,
+        raw=job.raw,
+        delimiter=job.delimiter,
+        clean=job.clean_values,
+        batch_size=job.batch_size,
+        stream=stream,
+    )
+
+
+def job_path(job):
+    if job.upload_file:
+        return job.upload_file.path
+    return job.file_name
+
+
+def run_job(job):
+    """ Run the import of a claimed job and record its log and status """
+    from csvimport.management.commands.importcsv import Command
+
+    cmd = Command()
+    cmd.progress = partial(report_progress, job)
+    try:
+        warn = setup_job(cmd, job)
+        if not warn:
+            # So the import can be resumed with importcsv --resume if the worker dies
+            cmd.start_checkpoints(job, job_path(job))
+        if warn:
+            errors, status = [warn], "failed"
+        else:
+            errors, status = cmd.run(logid=job.id), "done"
+    except Exception as err:
+        errors, status = ["Import failed: %s" % err], "failed"
+    job.status = status
+    job.error_log = "\n".join(errors)
+    job.finished_at = timezone.now()
+    if job.started_at:
+        job.run_seconds = (job.finished_at - job.started_at).total_seconds()
+    CSVImport.objects.filter(id=job.id).update(
+        status=job.status,
+        error_log=job.error_log,
+        finished_at=job.finished_at,
+        run_seconds=job.run_seconds,
+    )
+    ImportLock.objects.filter(csvimport=job).delete()
+    return job
+
+
+def enqueue_chunks(job, parts):
+    """ Queue a job with its file split into record aligned chunks for workers to lease.
+        Returns a warning if the file cannot be imported
+    """
+    from csvimport.management.commands.importcsv import Command
+
+    cmd = Command()
+    warn = setup_job(cmd, job, stream=True)
+    cmd.close_csvfile()
+    if warn:
+        return warn
+    path = job_path(job)
+    if not os.path.isfile(path):
+        return "Only a file can be split into chunks"
+    if codecs.lookup(cmd.charset or "utf-8").name.startswith(("utf-16", "utf-32")):
+        # The record boundaries are found in the bytes so these cannot be split
+        parts = 1
+    ranges = cmd.record_ranges(path, parts)
+    job.chunks = len(ranges)
+    enqueue(job, start=False)
+    ImportChunk.objects.bulk_create(
+        [
+            ImportChunk(csvimport=job, part=part, start=start, end=end)
+            for part, (start, end) in enumerate(ranges)
+        ]
+    )
+    return None
+
+
+def worker_name():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def lease_chunk(worker=None):
+    """ Lease the next queued chunk, or one whose lease has run out, that has free
+        import slots to the worker. The update only matches the chunk as it was read
+        so only one worker gets the lease
+    """
+    now = timezone.now()
+    fail_expired_chunks(now)
+    chunks = (
+        ImportChunk.objects.filter(
+            Q(status="queued")
+            | Q(status="running", lease_until__lt=now, attempts__lt=CSVIMPORT_CHUNK_ATTEMPTS),
+            csvimport__status__in=("queued", "running"),
+        )
+        .select_related("csvimport")
+        .order_by("-csvimport__priority", "csvimport__queued_at", "csvimport__id", "part")
+    )
+    for chunk in chunks[:10]:
+        locks = acquire_slots(chunk.csvimport.model_name)
+        if locks is None:
+            continue
+        leased = ImportChunk.objects.filter(
+            id=chunk.id, status=chunk.status, attempts=chunk.attempts
+        ).update(
+            status="running",
+            worker=worker or worker_name(),
+            lease_until=now + timedelta(seconds=CSVIMPORT_LEASE_SECONDS),
+            attempts=F("attempts") + 1,
+        )
+        if leased:
+            chunk.refresh_from_db()
+            # The slots are held for the lease, so a worker that dies frees them when it runs out
+            ImportLock.objects.filter(id__in=[lock.id for lock in locks]).update(
+                expires_at=chunk.lease_until
+            )
+            chunk.locks = locks
+            job = chunk.csvimport
+            if job.status == "queued":
+                wait = (now - job.queued_at).total_seconds() if job.queued_at else None
+                CSVImport.objects.filter(id=job.id, status="queued").update(
+                    status="running", started_at=now, wait_seconds=wait
+                )
+            return chunk
+        release_slots(locks)
+    return None
+
+
+def fail_expired_chunks(now):
+    """ Mark the chunks whose lease has run out on their last attempt as failed,
+        so their job can be finished rather than left running
+    """
+    chunks = ImportChunk.objects.filter(
+        status="running", lease_until__lt=now, attempts__gte=CSVIMPORT_CHUNK_ATTEMPTS
+    ).select_related("csvimport")
+    for chunk in chunks:
+        if ImportChunk.objects.filter(
+            id=chunk.id, status="running", attempts=chunk.attempts, lease_until__lt=now
+        ).update(
+            status="failed",
+            error_log="Part %s: Lease ran out after %s attempts" % (chunk.part, chunk.attempts),
+        ):
+            finish_chunks(chunk.csvimport)
+
+
+def run_chunk(chunk):
+    """ Import the rows of a leased chunk through the usual import path.
+        The rows and the chunk marked done are committed together, so a chunk
+        is only imported once even if its lease runs out and it is leased again
+    """
+    from csvimport.management.commands.importcsv import Command
+
+    job = CSVImport.objects.get(id=chunk.csvimport_id)
+    cmd = Command()
+    cmd.progress = partial(chunk_progress, chunk)
+    try:
+        with transaction.atomic():
+            warn = setup_job(cmd, job, stream=True)
+            if warn:
+                raise ChunkError(warn)
+            cmd.close_csvfile()
+            rows = cmd.read_range(job_path(job), chunk.start, chunk.end, cmd.delimiter, cmd.reader)
+            if chunk.part and (not cmd.mappings or cmd.nameindexes):
+                # Only the first chunk has the header row that is skipped
+                rows = [cmd.header] + rows
+            cmd.csvfile = rows
+            loglist = ["Part %s: %s" % (chunk.part, line) for line in cmd.run(logid=job.id)]
+            done = ImportChunk.objects.filter(
+                id=chunk.id, status="running", worker=chunk.worker, attempts=chunk.attempts
+            ).update(status="done", rows=chunk.rows, error_log="\n".join(loglist))
+            if not done:
+                raise ChunkError("Part %s was leased to another worker" % chunk.part)
+        chunk.status = "done"
+    except Exception as err:
+        status = "failed" if chunk.attempts >= CSVIMPORT_CHUNK_ATTEMPTS else "queued"
+        if ImportChunk.objects.filter(
+            id=chunk.id, status="running", worker=chunk.worker, attempts=chunk.attempts
+        ).update(status=status, error_log="Part %s: Import failed: %s" % (chunk.part, err)):
+            chunk.status = status
+    finally:
+        release_slots(getattr(chunk, "locks", []))
+    finish_chunks(job)
+    return chunk
+
+
+def chunk_progress(chunk, rows):
+    """ Record the rows a chunk has read and renew its lease once a third of it has passed,
+        stopping the import if the chunk has been leased to another worker
+    """
+    chunk.rows = rows
+    renew_at = chunk.lease_until - timedelta(seconds=CSVIMPORT_LEASE_SECONDS * 2 / 3.0)
+    if timezone.now() >= renew_at and not renew_lease(chunk):
+        raise ChunkError("Part %s was leased to another worker" % chunk.part)
+
+
+def renew_lease(chunk):
+    """ Extend the lease of a running chunk, returning False if it has been leased to
+        another worker. The rows of the chunk are imported in a transaction, so the lease
+        is committed from a thread with its own connection for other workers to see
+    """
+    lease_until = timezone.now() + timedelta(seconds=CSVIMPORT_LEASE_SECONDS)
+    renewed = []
+
+    def renew():
+        try:
+            renewed.append(
+                ImportChunk.objects.filter(
+                    id=chunk.id, status="running", worker=chunk.worker, attempts=chunk.attempts
+                ).update(lease_until=lease_until)
+            )
+            if renewed[0]:
+                ImportLock.objects.filter(
+                    id__in=[lock.id for lock in getattr(chunk, "locks", [])]
+                ).update(expires_at=lease_until)
+        except DatabaseError:
+            # The import's own transaction may lock the database, as sqlite does,
+            # in which case no other worker can lease the chunk either
+            pass
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=renew)
+    thread.start()
+    thread.join()
+    if not renewed:
+        return True
+    if renewed[0]:
+        chunk.lease_until = lease_until
+    return bool(renewed[0])
+
+
+def finish_chunks(job):
+    """ Total the progress of the chunks of a job and record it as done when they all are,
+        or failed if a chunk has failed
+    """
+    chunks = ImportChunk.objects.filter(csvimport=job)
+    rows = chunks.filter(status="done").aggregate(rows=Sum("rows"))["rows"] or 0
+    CSVImport.objects.filter(id=job.id).update(progress=rows)
+    if chunks.filter(status="failed").exists():
+        status = "failed"
+    elif not chunks.exclude(status="done").exists():
+        status = "done"
+    else:
+        return
+    now = timezone.now()
+    CSVImport.objects.filter(id=job.id, status="running").update(
+        status=status,
+        error_log="\n".join([chunk.error_log for chunk in chunks.order_by("part") if chunk.error_log]),
+        finished_at=now,
+        run_seconds=(now - job.started_at).total_seconds() if job.started_at else None,
+    )
+
+
+def run_next(worker=None):
+    """ Run the next queued job, or leased chunk, and return it or None if there are none """
+    job = claim_job()
+    if job:
+        return run_job(job)
+    chunk = lease_chunk(worker)
+    if chunk:
+        return run_chunk(chunk)
+    return None
+
+
+def waiting():
+    """ True if there are queued jobs or chunks still to run """
+    return (
+        CSVImport.objects.filter(status="queued", chunks=0).exists()
+        or ImportChunk.objects.filter(status="queued").exists()
+    )
+
+
+class ChunkError(Exception):
+    pass
+
+
+def run_queued(sleep=5.0):
+    """ Run queued jobs and chunks until there are none left. Those waiting for import slots
+        held by other imports are polled for until the slots are free, since nothing else
+        would start them without a worker process
+    """
+    try:
+        while True:
+            if run_next():
+                continue
+            if not waiting():
+                break
+            time.sleep(sleep)
+    finally:
+        # Each thread has its own connection
+        connection.close()
@@ -0,0 +1,55 @@
+""" Django command to run the imports queued from the admin
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from csvimport.jobs import run_next, worker_name
+from csvimport.models import ImportChunk
+
+
+class Command(BaseCommand):
+    """
+    Run queued CSVImport jobs, and lease the chunks of split ones,
+    polling the queue for new ones
+    """
+
+    help = "Runs the csv imports queued from the admin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sleep",
+            default=5.0,
+            type=float,
+            help="Seconds to wait before polling an empty queue again",
+        )
+        parser.add_argument(
+            "--once",
+            default=False,
+            action="store_true",
+            help="Stop when the queue is empty rather than polling it",
+        )
+        parser.add_argument(
+            "--name",
+            default="",
+            help="Name the worker holds chunk leases under, default host:pid",
+        )
+
+    def handle(self, *args, **options):
+        worker = options.get("name") or worker_name()
+        while True:
+            done = run_next(worker)
+            if isinstance(done, ImportChunk):
+                self.stdout.write(
+                    "%s part %s of import %s, %s rows"
+                    % (done.status, done.part, done.csvimport_id, done.rows)
+                )
+            elif done:
+                self.stdout.write(
+                    "%s import %s of %s, %s rows"
+                    % (done.status, done.id, done.file_name, done.progress)
+                )
+            elif options.get("once"):
+                return
+            else:
+                time.sleep(options.get("sleep", 5.0))
@@ -4,7 +4,12 @@
 import os
 import csv
 import re
+import itertools
+import multiprocessing
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from functools import partial
 
 import codecs
 import chardet
@@ -13,10 +18,12 @@ from distutils.version import StrictVersion
 
 from django.db import DatabaseError
 from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, router
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.management.base import LabelCommand, BaseCommand, CommandError
 from optparse import make_option
 from django.db import models
+from django.db.models import Q
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 
@@ -29,7 +36,10 @@ except ImportError:
     get_model = apps.get_model
 
 from django.conf import settings
-from csvimport.parser import CSVParser
+from csvimport.parser import CSVParser, CHARSET_DETECTORS, CHARSET_SAMPLE_BYTES
+from csvimport.dedupe import DEDUPE_INDEXES, SpillSet
+from csvimport.engines import ENGINES, get_engine, loading
+from csvimport.rowindex import get_row_index
 from csvimport.signals import imported_csv, importing_csv
 
 CSVIMPORT_LOG = getattr(settings, "CSVIMPORT_LOG", "screen")
@@ -52,6 +62,14 @@ SMALLINT_DBS = ["sqlite", "sqlite3", "sqlite4"]
 DATE = ["DateField", "TimeField", "DateTimeField"]
 BOOLEAN = ["BooleanField", "NullBooleanField"]
 BOOLEAN_TRUE = [1, "1", "Y", "Yes", "yes", "True", "true", "T", "t"]
+# Rows are read in chunks of batch size, or this if it is not set
+CHUNK_SIZE = 1000
+# Keep query parameter counts under the lowest backend limit, sqlite's 999
+IN_QUERY_SIZE = 500
+# A file parsed by workers is split into parts of about this many bytes,
+# with up to this many parts per worker parsed or waiting to be imported
+PART_BYTES = 4 * 1024 * 1024
+PARTS_IN_FLIGHT = 2
 
 # Adding Support for Django 1.9+
 if StrictVersion(django.get_version()) >= StrictVersion("1.9.0"):
@@ -60,6 +78,19 @@ else:
     DATE_INPUT_FORMATS = settings.DATE_INPUT_FORMATS or ("%d/%m/%Y", "%Y/%m/%d")
 
 CSV_DATE_INPUT_FORMATS = DATE_INPUT_FORMATS + ("%d-%m-%Y", "%Y-%m-%d")
+# Columns found to be in these formats are parsed with the faster ISO parser
+ISO_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+)
+try:
+    from ciso8601 import parse_datetime as parse_isodate
+except ImportError:
+    # Python 3.7 or later
+    parse_isodate = getattr(datetime, "fromisoformat", None)
 cleancol = re.compile("[^0-9a-zA-Z]+")  # cleancol.sub('_', s)
 
 from django import dispatch
@@ -100,6 +131,65 @@ def save_csvimport(props=None, instance=None):
         return
 
 
+def init_worker():
+    """ Set up django in a worker process, if it is spawned rather than forked """
+    django.setup()
+
+
+def import_file(args):
+    """ Import a file in a worker process, with its own database connection
+        and CSVImport log record. Returns the file path, CSVImport id and log
+    """
+    filepath, options = args
+    cmd = Command()
+    warn = cmd.setup_options(filepath, options)
+    if warn:
+        return filepath, None, [warn]
+    # Each file takes its own slots, so the pool runs no more imports than the limits allow
+    loglist = cmd.run_in_slots(options.get("model", "Item"))
+    logid = None
+    if cmd.props:
+        try:
+            logid = save_csvimport(cmd.props)
+        except:
+            pass
+    return filepath, logid, loglist
+
+
+def clean_range(args):
+    """ Parse and clean the rows in a byte range of a file in a worker process.
+        Foreign keys are left for the importing process to look up.
+        Returns the rows and log
+    """
+    filepath, options, part, start, end = args
+    cmd = Command()
+    cmd.setup_options(
+        filepath, dict(options, stream=True, start_row=0, end_row=0, limit=0, row_index=False)
+    )
+    cmd.close_csvfile()
+    loglist = []
+    cmd.load_mappings(loglist)
+    loglist = []
+    plan = [
+        (column, cleaner)
+        for (column, field, foreignkey, cleaner) in cmd.compile_plan()
+        if cmd.clean and cleaner and not foreignkey
+    ]
+    rows = cmd.read_range(
+        filepath, start, end, delimiter=options.get("delimiter", ","), reader=True
+    )
+    # The header row is only in the first range
+    skip = cmd.start if part == 0 else 0
+    for index, row in enumerate(rows[skip:]):
+        for (column, cleaner) in plan:
+            if column < len(row):
+                try:
+                    row[column] = cleaner(row[column], loglist, index)
+                except:
+                    pass
+    return rows, ["Part %s: %s" % (part, line) for line in loglist]
+
+
 class Command(LabelCommand, CSVParser):
     """
     Parse and import a CSV resource to a Django model.
@@ -128,6 +218,16 @@ class Command(LabelCommand, CSVParser):
             "default": False,
             "help": "Force the charset conversion used rather than detect it",
         },
+        "charset-sample-bytes": {
+            "default": CHARSET_SAMPLE_BYTES,
+            "type": int,
+            "help": "Number of bytes from the start of the file used to detect the charset, 0 for the whole file",
+        },
+        "charset-detector": {
+            "default": "chardet",
+            "choices": CHARSET_DETECTORS,
+            "help": "Library used to detect the charset, cchardet or charset_normalizer are faster if installed",
+        },
         "delimiter": {
             "default": ",",
             "help": "Specify the CSV delimiter - default is comma, use \t for tab",
@@ -140,12 +240,136 @@ class Command(LabelCommand, CSVParser):
             "default": False,
             "help": "If True, all csv rows are created at once by a bulk create, so can fail if any have data issues, but its faster",
         },
+        "batch-size": {
+            "default": 0,
+            "type": int,
+            "help": "Bulk create rows in chunks of this size, each committed in its own transaction, implies bulk",
+        },
+        "bisect": {
+            "default": False,
+            "help": "If True, a failed bulk create chunk is split in half and retried until only the bad rows are left out",
+        },
+        "fkey-cache-size": {
+            "default": 10000,
+            "type": int,
+            "help": "Number of foreign key values to keep in the lookup cache, 0 turns the cache off",
+        },
+        "fkey-prepass": {
+            "default": False,
+            "help": "If True, the foreign key values for each chunk of rows are loaded in one query and any missing ones bulk created",
+        },
+        "dedupe-keys": {
+            "default": "",
+            "help": "Comma separated fields that identify a duplicate row, checked with one query per chunk "
+            "so rows can be bulk created, implies bulk",
+        },
+        "dedupe-index": {
+            "default": "query",
+            "choices": ["query"] + sorted(DEDUPE_INDEXES),
+            "help": "How --dedupe-keys are checked, a query per chunk or an in memory set or bloom filter "
+            "of the keys in the table, loaded once at the start",
+        },
+        "dedupe-error-rate": {
+            "default": 0.001,
+            "type": float,
+            "help": "False positive rate of the bloom filter dedupe index, its hits are checked against the table",
+        },
+        "dedupe-spill": {
+            "default": 100000,
+            "type": int,
+            "help": "Number of row hashes kept in memory to skip rows repeated in the file before they are moved "
+            "to a temporary file, 0 turns off skipping repeated rows",
+        },
+        "upsert": {
+            "default": False,
+            "help": "If True, rows whose --conflict-keys are already in the table are updated rather than created, implies bulk",
+        },
+        "conflict-keys": {
+            "default": "",
+            "help": "Comma separated fields that identify an existing row for --upsert, ideally with a unique constraint",
+        },
+        "update-fields": {
+            "default": "",
+            "help": "Comma separated fields updated by --upsert, defaults to the mapped fields that are not conflict keys",
+        },
+        "sync": {
+            "default": False,
+            "help": "If True, the file is a snapshot of the table, so rows matched on --conflict-keys are updated, "
+            "new ones created and those not in the file deleted",
+        },
+        "engine": {
+            "default": "orm",
+            "choices": ENGINES,
+            "help": "How rows are bulk loaded, copy streams them with COPY FROM STDIN for postgresql, "
+            "sqlite inserts them with executemany in one transaction, otherwise the orm bulk create is used, implies bulk",
+        },
+        "raw": {
+            "default": False,
+            "help": "If True, rows are converted to tuples of column values rather than model instances "
+            "and inserted by the --engine, or the backends multi row insert, implies bulk",
+        },
+        "workers": {
+            "default": 0,
+            "type": int,
+            "help": "Number of worker processes to import the csv files of a directory in parallel, "
+            "or to parse and clean byte ranges of a single file for this process to write",
+        },
+        "queue": {
+            "default": False,
+            "help": "If True, queue the import for a csvimport_worker rather than running it now",
+        },
+        "priority": {
+            "default": 0,
+            "type": int,
+            "help": "Priority of a queued import, higher runs first",
+        },
+        "chunks": {
+            "default": 0,
+            "type": int,
+            "help": "Split a queued file into this many record aligned chunks for csvimport_worker "
+            "processes, on any host that shares the file system, to lease and import",
+        },
+        "start-row": {
+            "default": 0,
+            "type": int,
+            "help": "Start the import at this data row, counting from 0",
+        },
+        "end-row": {
+            "default": 0,
+            "type": int,
+            "help": "End the import before this data row",
+        },
+        "limit": {
+            "default": 0,
+            "type": int,
+            "help": "Import at most this many rows",
+        },
+        "row-index": {
+            "default": False,
+            "help": "If True, memory map the file and index its record offsets, saved in a .rowindex "
+            "sidecar file, so row slices, parallel ranges and checkpoints seek rather than parse",
+        },
+        "checkpoint": {
+            "default": False,
+            "help": "If True, save the row and byte offset of each committed batch on a CSVImport "
+            "record so the import can be resumed",
+        },
+        "resume": {
+            "default": 0,
+            "type": int,
+            "help": "Resume the import of this CSVImport id from its last checkpoint",
+        },
+        "stream": {
+            "default": False,
+            "help": "If True, rows are read from the file one at a time rather than loading it all into memory first",
+        },
     }
 
     # Use 1.10 or later arguments method
     def add_arguments(self, parser):
         parser.add_argument(
             "csvfile",
+            nargs="?",
             help="The file system path to the CSV file with the data to import",
         )
         for arg in self.options:
@@ -164,6 +388,8 @@ class Command(LabelCommand, CSVParser):
         """ Set default attributes data types """
         super(Command, self).__init__()
         self.props = {}
+        self.wait_seconds = None
+        self.run_seconds = None
         self.debug = False
         self.errors = []
         self.loglist = []
@@ -172,15 +398,63 @@ class Command(LabelCommand, CSVParser):
         self.app_label = ""
         self.model = ""
         self.fieldmap = {}
+        self.cleaners = {}
+        self.plan = []
         self.file_name = ""
         self.nameindexes = False
         self.deduplicate = True
+        self.dedupe_keys = []
+        self.dedupe_skipped = 0
+        self.dedupe_index = "query"
+        self.dedupe_error_rate = 0.001
+        self.key_index = None
+        self.dedupe_spill = 100000
+        self.repeats_skipped = 0
+        self.conflict_keys = []
+        self.update_fields = []
+        self.upserted = 0
+        self.sync = False
+        self.engine_name = "orm"
+        self.engine = None
+        self.raw = False
+        self.raw_plan = []
+        self.raw_template = []
+        self.raw_fresh = []
+        self.raw_instance = None
         self.csvfile = []
+        self.header = []
+        self.indexes = []
         self.charset = ""
-        self.filehandle = None
         self.makemodel = ""
         self.start = 1
         self.db_backend = ""
+        self.batch_size = 0
+        self.bisect = False
+        self.chunk_count = 0
+        self.chunk_seconds = 0
+        self.chunk_max = 0
+        self.fkey_models = {}
+        self.fkey_cache = OrderedDict()
+        self.fkey_cache_size = 10000
+        self.fkey_prepass = False
+        self.fkey_hits = 0
+        self.fkey_misses = 0
+        # Called with the number of rows read after each chunk
+        self.progress = None
+        self.delimiter = ","
+        self.reader = True
+        self.row_offset = 0
+        self.skip_rows = 0
+        self.end_row = 0
+        self.row_index = None
+        self.rows_read = 0
+        self.checkpoint_id = 0
+        self.checkpoint_path = None
+        self.checkpoint_row = 0
+        self.checkpoint_offset = 0
+        self.scanned_row = 0
+        self.scanned_offset = 0
+        self.scanned_ends = None
 
     def handle(self, *args, **options):
         if args:
@@ -193,15 +467,381 @@ class Command(LabelCommand, CSVParser):
         """ Handle the circular reference by passing the nested
             save_csvimport function
         """
+        from csvimport.jobs import job_path
+
         self.loglist = []
+        if options.get("queue"):
+            print(self.queue_import(label, options))
+            return
+        csvimport = None
+        if options.get("resume"):
+            csvimport = self.resume_import(options["resume"])
+            if not hasattr(csvimport, "id"):
+                print(csvimport)
+                return
+            label = label or job_path(csvimport)
+            options = dict(
+                options,
+                model=csvimport.model_name,
+                mappings=csvimport.field_list,
+                charset=csvimport.encoding,
+                upsert=bool(csvimport.conflict_keys),
+                conflict_keys=csvimport.conflict_keys,
+                update_fields=csvimport.update_fields,
+                defaults=csvimport.defaults,
+                dedupe_keys=csvimport.dedupe_keys,
+                engine=csvimport.engine,
+                raw=csvimport.raw,
+                delimiter=csvimport.delimiter,
+                clean=csvimport.clean_values,
+                batch_size=csvimport.batch_size,
+                stream=True,
+                workers=0,
+            )
+        elif options.get("checkpoint"):
+            options = dict(options, workers=0)
+        workers = options.get("workers", 0)
+        modelname = options.get("model", "Item")
+        if workers > 1 and label and os.path.isdir(label):
+            for line in self.run_workers(label, options, workers):
+                print(line)
+            return
+        parallel = workers > 1 and label and os.path.isfile(label)
+        if parallel:
+            options = dict(options, stream=True)
+        warn = self.setup_options(label, options)
+        if parallel and not warn:
+            if codecs.lookup(self.charset or "utf-8").name.startswith(("utf-16", "utf-32")):
+                self.loglist.append(
+                    "A %s file cannot be split into byte ranges so it is parsed here"
+                    % self.charset
+                )
+            else:
+                # Workers parse and clean the rows, this process writes them
+                self.close_csvfile()
+                self.csvfile = self.parallel_rows(label, options, workers)
+                self.clean = False
+                # The workers parse the whole file so skip to the start row here
+                self.skip_rows = self.row_offset
+        if warn:
+            try:
+                print(warn)
+            except:
+                self.loglist.append(warn)
+                raise CommandError(warn)
+            return
+        if options.get("checkpoint") and not csvimport:
+            csvimport = self.checkpoint_import(label, options)
+        if csvimport:
+            self.start_checkpoints(csvimport, label, resume=bool(options.get("resume")))
+        self.loglist.extend(self.run_in_slots(modelname, logid=csvimport.id if csvimport else 0))
+        if csvimport:
+            self.finish_checkpoints(csvimport)
+        if self.props:
+            save_csvimport(self.props, self)
+        return
+
+    def run_in_slots(self, modelname, logid=0):
+        """ Run the import once its import slots are free, timing the wait for them
+            and the run, which are saved with the log like those of a queued import
+        """
+        from csvimport.jobs import import_slots
+
+        started = time.time()
+        with import_slots(modelname):
+            running = time.time()
+            self.wait_seconds = running - started
+            loglist = self.run(logid=logid)
+            self.run_seconds = time.time() - running
+        if self.props:
+            self.props.update(wait_seconds=self.wait_seconds, run_seconds=self.run_seconds)
+        return loglist
+
+    def resume_import(self, csvimport_id):
+        """ Get the CSVImport record of an import to resume, or a warning """
+        from csvimport.models import CSVImport
+
+        try:
+            csvimport = CSVImport.objects.get(id=csvimport_id)
+        except CSVImport.DoesNotExist:
+            return "No CSVImport %s to resume" % csvimport_id
+        if csvimport.status == "done":
+            return "CSVImport %s is already done" % csvimport_id
+        return csvimport
+
+    def checkpoint_import(self, label, options):
+        """ Create the CSVImport record for an import with checkpoints before it starts """
+        from csvimport.models import CSVImport
+
+        return CSVImport.objects.create(
+            model_name=options.get("model", "Item"),
+            field_list=options.get("mappings") or "",
+            file_name=os.path.abspath(label),
+            encoding=self.charset or "",
+            upload_method="cronjob",
+            import_user="cron",
+            conflict_keys=options.get("conflict_keys") or "",
+            update_fields=options.get("update_fields") or "",
+            defaults=options.get("defaults") or "",
+            dedupe_keys=options.get("dedupe_keys") or "",
+            engine=options.get("engine") or "orm",
+            raw=bool(options.get("raw")),
+            delimiter=options.get("delimiter") or ",",
+            clean_values=bool(options.get("clean", True)),
+            batch_size=options.get("batch_size") or 0,
+            status="running",
+            started_at=timezone.now(),
+        )
+
+    def start_checkpoints(self, csvimport, filepath, resume=False):
+        """ Save checkpoints of the rows committed on the CSVImport record and,
+            if resuming, start the rows from its last checkpoint
+        """
+        from csvimport.models import CSVImport
+
+        self.checkpoint_id = csvimport.id
+        # Record ends are found in the bytes so only a single file of a byte charset has offsets
+        if (
+            filepath
+            and os.path.isfile(filepath)
+            and not codecs.lookup(self.charset or "utf-8").name.startswith(("utf-16", "utf-32"))
+        ):
+            self.checkpoint_path = filepath
+        if not resume or not csvimport.checkpoint_row:
+            CSVImport.objects.filter(id=csvimport.id).update(checkpoint_row=0, checkpoint_offset=0)
+            return
+        self.checkpoint_row = self.scanned_row = self.row_offset = csvimport.checkpoint_row
+        self.checkpoint_offset = self.scanned_offset = csvimport.checkpoint_offset
+        if self.checkpoint_path and self.checkpoint_offset:
+            self.close_csvfile()
+            self.csvfile = self.header_rows(
+                self.seek_rows(filepath, self.checkpoint_offset, self.delimiter, self.reader)
+            )
+        else:
+            # Without an offset the committed rows are read again but not imported
+            self.checkpoint_path = None
+            self.skip_rows = self.checkpoint_row
+        self.loglist.append(
+            "Resumed import %s at row %s" % (csvimport.id, self.checkpoint_row)
+        )
+
+    def save_checkpoint(self):
+        """ Record the rows read, and the byte offset after them, on the CSVImport record.
+            Called in the transaction that commits the rows
+        """
+        from csvimport.models import CSVImport
+
+        if not self.checkpoint_id or self.rows_read <= self.checkpoint_row:
+            return
+        if self.checkpoint_path and self.row_index is not None:
+            self.scanned_offset = self.row_index.start(self.start + self.rows_read)
+            self.scanned_row = self.rows_read
+        elif self.checkpoint_path:
+            if self.scanned_ends is None:
+                self.scanned_ends = self.record_ends(self.checkpoint_path, self.scanned_offset)
+                if not self.scanned_offset:
+                    # Move past the header rows that are not imported
+                    for count in range(self.start):
+                        self.scanned_offset = next(self.scanned_ends, self.scanned_offset)
+            while self.scanned_row < self.rows_read:
+                self.scanned_offset = next(self.scanned_ends, self.scanned_offset)
+                self.scanned_row += 1
+        CSVImport.objects.filter(id=self.checkpoint_id).update(
+            checkpoint_row=self.rows_read,
+            checkpoint_offset=self.scanned_offset if self.checkpoint_path else 0,
+            progress=self.rows_read,
+        )
+        self.checkpoint_row = self.rows_read
+        self.checkpoint_offset = self.scanned_offset
+
+    def finish_checkpoints(self, csvimport):
+        """ Record the import with checkpoints as done with its log, or as failed
+            if no columns could be mapped so nothing was imported
+        """
+        from csvimport.models import CSVImport
+
+        if self.scanned_ends is not None:
+            self.scanned_ends.close()
+        error_log = "\n".join([line for line in self.loglist if isinstance(line, str)])
+        if self.row_offset and csvimport.error_log:
+            error_log = csvimport.error_log + "\n" + error_log
+        CSVImport.objects.filter(id=csvimport.id).update(
+            status="done" if self.mappings else "failed",
+            error_log=error_log,
+            progress=self.rows_read,
+            finished_at=timezone.now(),
+            wait_seconds=self.wait_seconds,
+            run_seconds=self.run_seconds,
+        )
+
+    def header_rows(self, rows):
+        """ Put the header row back in front of rows from the middle of a file
+            if the import skips it
+        """
+        if self.header_count():
+            return itertools.chain([self.header], rows)
+        return rows
+
+    def queue_import(self, label, options):
+        """ Queue the import of a file to be run by a csvimport_worker """
+        from csvimport.jobs import enqueue, enqueue_chunks
+        from csvimport.models import CSVImport
+
+        if not label or not os.path.exists(label):
+            return 'File "%s" not found' % label
+        if options.get("sync"):
+            # A queued import is run as an upsert, or in chunks that would delete each other's rows
+            return "Sync cannot be combined with --queue"
+        job = CSVImport(
+            model_name=options.get("model", "Item"),
+            field_list=options.get("mappings") or "",
+            file_name=os.path.abspath(label),
+            encoding=options.get("charset") or "",
+            upload_method="cronjob",
+            import_user="cron",
+            conflict_keys=options.get("conflict_keys") or "",
+            update_fields=options.get("update_fields") or "",
+            defaults=options.get("defaults") or "",
+            dedupe_keys=options.get("dedupe_keys") or "",
+            engine=options.get("engine") or "orm",
+            raw=bool(options.get("raw")),
+            delimiter=options.get("delimiter") or ",",
+            clean_values=bool(options.get("clean", True)),
+            batch_size=options.get("batch_size") or 0,
+            priority=options.get("priority", 0),
+        )
+        chunks = options.get("chunks", 0)
+        if chunks > 1:
+            warn = enqueue_chunks(job, chunks)
+            if warn:
+                return warn
+            return "Queued import %s of %s in %s chunks" % (job.id, job.file_name, job.chunks)
+        enqueue(job, start=False)
+        return "Queued import %s of %s" % (job.id, job.file_name)
+
+    def run_workers(self, dirpath, options, workers):
+        """ Import the csv files of a directory in a pool of worker processes
+            and return a summary of the imports
+        """
+        if options.get("sync"):
+            # Each file's sync would delete the rows imported from the others
+            return ["Sync cannot be combined with --workers for a directory"]
+        filepaths = sorted(
+            [
+                os.path.join(dirpath, afile)
+                for afile in os.listdir(dirpath)
+                if afile.endswith(".csv")
+            ]
+        )
+        options = self.worker_options(options)
+        model = None
+        if options.get("model", "").find(".") > -1:
+            model = get_model(*options["model"].rsplit(".", 1))
+        # The files' own row counts overlap as they import at the same time so count the total here
+        rowcount = model.objects.count() if model else 0
+        # Each worker process must open its own database connections
+        connections.close_all()
+        pool = multiprocessing.Pool(min(workers, len(filepaths) or 1), init_worker)
+        try:
+            results = pool.map(
+                import_file, [(filepath, options) for filepath in filepaths], chunksize=1
+            )
+        finally:
+            pool.close()
+            pool.join()
+        if model:
+            rowcount = model.objects.count() - rowcount
+        return self.summarise(results, workers, rowcount)
+
+    def parallel_rows(self, filepath, options, workers):
+        """ Rows of a file parsed and cleaned in byte ranges by a pool of worker processes,
+            in the order of the file, for importing here.
+            The ranges are small and only a few per worker are in flight at once,
+            so memory use stays bounded however far the import falls behind
+        """
+        options = self.worker_options(options)
+        options["charset"] = self.charset
+        parts = max(workers, os.path.getsize(filepath) // PART_BYTES + 1)
+        if self.row_index is not None:
+            ranges = self.row_index.ranges(parts)
+        else:
+            ranges = self.record_ranges(filepath, parts)
+        connections.close_all()
+        pool = multiprocessing.Pool(min(workers, len(ranges)), init_worker)
+        try:
+            jobs = (
+                (filepath, options, part, start, end)
+                for part, (start, end) in enumerate(ranges)
+            )
+            pending = deque(
+                pool.apply_async(clean_range, (job,))
+                for job in itertools.islice(jobs, workers * PARTS_IN_FLIGHT)
+            )
+            while pending:
+                rows, loglist = pending.popleft().get()
+                for job in itertools.islice(jobs, 1):
+                    pending.append(pool.apply_async(clean_range, (job,)))
+                self.loglist.extend(loglist)
+                for row in rows:
+                    yield row
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def worker_options(self, options):
+        """ Only the import options are passed to workers, with workers off """
+        names = [arg.replace("-", "_") for arg in self.options]
+        options = dict((name, options[name]) for name in names if name in options)
+        options["workers"] = 0
+        return options
+
+    def summarise(self, results, workers, rowcount):
+        """ Summary of the results of importing files with workers """
+        lines = []
+        for filepath, logid, loglist in results:
+            line = "%s: %s log lines" % (os.path.basename(filepath), len(loglist))
+            if logid:
+                line += " in CSVImport %s" % logid
+            else:
+                line += " - %s" % loglist[-1]
+            lines.append(line)
+        lines.append(
+            "Imported %s rows from %s files with %s workers"
+            % (rowcount, len(results), workers)
+        )
+        return lines
+
+    def setup_options(self, label, options):
+        """ Setup from the command options for importing the file """
         filename = label
         mappings = options.get("mappings", [])
         defaults = options.get("defaults", [])
         modelname = options.get("model", "Item")
         charset = options.get("charset", "")
+        charset_sample_bytes = options.get("charset_sample_bytes", CHARSET_SAMPLE_BYTES)
+        charset_detector = options.get("charset_detector", "chardet")
         delimiter = options.get("delimiter", ",")
         clean = options.get("clean", True)
         bulk = options.get("bulk", False)
+        batch_size = options.get("batch_size", 0)
+        bisect = options.get("bisect", False)
+        stream = options.get("stream", False)
+        fkey_cache_size = options.get("fkey_cache_size", 10000)
+        fkey_prepass = options.get("fkey_prepass", False)
+        dedupe_keys = options.get("dedupe_keys", "")
+        dedupe_index = options.get("dedupe_index", "query")
+        dedupe_error_rate = options.get("dedupe_error_rate", 0.001)
+        dedupe_spill = options.get("dedupe_spill", 100000)
+        upsert = options.get("upsert", False)
+        conflict_keys = options.get("conflict_keys", "")
+        update_fields = options.get("update_fields", "")
+        sync = options.get("sync", False)
+        engine = options.get("engine", "orm")
+        raw = options.get("raw", False)
+        start_row = options.get("start_row", 0)
+        end_row = options.get("end_row", 0)
+        limit = options.get("limit", 0)
+        row_index = options.get("row_index", False)
         # show_traceback = options.get('traceback', True)
         warn = self.setup(
             mappings=mappings,
@@ -212,23 +852,34 @@ class Command(LabelCommand, CSVParser):
             delimiter=delimiter,
             clean=clean,
             bulk=bulk,
+            batch_size=batch_size,
+            bisect=bisect,
+            stream=stream,
+            fkey_cache_size=fkey_cache_size,
+            fkey_prepass=fkey_prepass,
+            charset_sample_bytes=charset_sample_bytes,
+            charset_detector=charset_detector,
+            dedupe_keys=dedupe_keys,
+            dedupe_index=dedupe_index,
+            dedupe_error_rate=dedupe_error_rate,
+            dedupe_spill=dedupe_spill,
+            upsert=upsert,
+            conflict_keys=conflict_keys,
+            update_fields=update_fields,
+            sync=sync,
+            engine=engine,
+            raw=raw,
+            start_row=start_row,
+            end_row=end_row,
+            limit=limit,
+            row_index=row_index,
         )
         if not warn and not hasattr(self.model, "_meta"):
             warn = (
                 "Sorry your model could not be found please check app_label.modelname = %s"
                 % modelname
             )
-        if warn:
-            try:
-                print(warn)
-            except:
-                self.loglist.append(warn)
-                raise CommandError(warn)
-            return
-        self.loglist.extend(self.run())
-        if self.props:
-            save_csvimport(self.props, self)
-        return
+        return warn
 
     def setup(
         self,
@@ -244,22 +895,87 @@ class Command(LabelCommand, CSVParser):
         reader=True,
         clean=True,
         bulk=False,
+        batch_size=0,
+        bisect=False,
+        stream=False,
+        fkey_cache_size=10000,
+        fkey_prepass=False,
+        charset_sample_bytes=CHARSET_SAMPLE_BYTES,
+        charset_detector="chardet",
+        dedupe_keys="",
+        dedupe_index="query",
+        dedupe_error_rate=0.001,
+        dedupe_spill=100000,
+        upsert=False,
+        conflict_keys="",
+        update_fields="",
+        sync=False,
+        engine="orm",
+        raw=False,
+        start_row=0,
+        end_row=0,
+        limit=0,
+        row_index=False,
     ):
         """ Setup up the attributes for running the import """
         self.clean = clean
-        self.bulk = bulk
+        self.cleaners = {}
+        self.plan = []
+        self.charset_sample_bytes = charset_sample_bytes
+        self.charset_detector = charset_detector
+        self.batch_size = batch_size or 0
+        self.sync = sync
+        if upsert or sync:
+            # Existing rows are updated so nothing is deduplicated
+            deduplicate = False
+            self.conflict_keys = self.split_fields(conflict_keys)
+            self.update_fields = self.split_fields(update_fields)
+        else:
+            self.conflict_keys = []
+            self.update_fields = []
+        self.upserted = 0
+        if deduplicate and dedupe_keys:
+            self.dedupe_keys = self.split_fields(dedupe_keys)
+        else:
+            self.dedupe_keys = []
+        self.engine_name = engine or "orm"
+        self.engine = None
+        self.raw = raw
+        self.bulk = (
+            raw
+            or bulk
+            or bool(self.batch_size)
+            or bool(self.dedupe_keys)
+            or upsert
+            or sync
+            or self.engine_name != "orm"
+        )
+        self.bisect = bisect
+        self.dedupe_skipped = 0
+        self.dedupe_index = dedupe_index
+        self.dedupe_error_rate = dedupe_error_rate
+        self.key_index = None
+        self.dedupe_spill = dedupe_spill
+        self.repeats_skipped = 0
+        self.fkey_cache_size = fkey_cache_size
+        self.fkey_prepass = fkey_prepass
         self.defaults = self.set_mappings(defaults)
         if modelname.find(".") > -1:
             app_label, model = modelname.rsplit(".", 1)
+        self.charset = charset
+        self.delimiter = delimiter
+        self.reader = reader
         if uploaded:
             self.csvfile = self.open_csvfile(
-                uploaded.path, delimiter=delimiter, reader=reader
+                uploaded.path, delimiter=delimiter, reader=reader, stream=stream
             )
+            self.get_header()
         else:
-            failed = self.check_filesystem(csvfile, delimiter=delimiter, reader=reader)
+            failed = self.check_filesystem(
+                csvfile, delimiter=delimiter, reader=reader, stream=stream
+            )
             if failed:
                 return failed
-        self.charset = charset
         self.app_label = app_label
         self.model = get_model(app_label, model)
         if not self.model:
@@ -273,32 +989,94 @@ class Command(LabelCommand, CSVParser):
             self.fieldmap[field.name] = field
             if field.__class__ == models.ForeignKey:
                 self.fieldmap[field.name + "_id"] = field
+        for key in self.dedupe_keys:
+            if key not in self.fieldmap:
+                return "Dedupe key %s is not a field of %s" % (key, modelname)
+        if raw and (self.dedupe_keys or upsert or sync):
+            return "Raw rows cannot be combined with --dedupe-keys, --upsert or --sync"
+        if sync and (start_row or end_row or limit):
+            # Rows outside the slice would be deleted as missing from the snapshot
+            return "Sync cannot be combined with --start-row, --end-row or --limit"
+        if (upsert or sync) and not self.conflict_keys:
+            return "%s needs the --conflict-keys that identify an existing row" % (
+                "Sync" if sync else "Upsert"
+            )
+        for key in self.conflict_keys + self.update_fields:
+            if key not in self.fieldmap:
+                return "Upsert field %s is not a field of %s" % (key, modelname)
+        if dedupe_index != "query" and not self.dedupe_keys:
+            return "A %s dedupe index needs the --dedupe-keys to index" % dedupe_index
         if mappings:
             if mappings == "none":
                 # Use auto numbered cols instead - eg. from create_new_model
                 mappings = self.parse_header(
-                    ["col_%s" % num for num in range(1, len(self.csvfile[0]))]
+                    ["col_%s" % num for num in range(1, len(self.header))]
                 )
             # Test for column=name or just name list format
             if mappings.find("=") == -1:
                 mappings = self.parse_header(mappings.split(","))
             self.mappings = self.set_mappings(mappings)
+        self.resolve_fkeys()
         self.nameindexes = bool(nameindexes)
         self.file_name = csvfile
         self.deduplicate = deduplicate
+        if row_index:
+            self.load_row_index(uploaded.path if uploaded else csvfile)
+        self.slice_rows(start_row, end_row, limit)
         return
 
+    def load_row_index(self, filepath):
+        """ Load or build the record offset index of a file """
+        if not filepath or not os.path.isfile(filepath):
+            self.loglist.append("Only a file can be indexed")
+        elif codecs.lookup(self.charset or "utf-8").name.startswith(("utf-16", "utf-32")):
+            self.loglist.append("A %s file cannot be indexed by its bytes" % self.charset)
+        else:
+            self.row_index = get_row_index(filepath, self.delimiter_bytes())
+        return self.row_index
+
+    def slice_rows(self, start_row=0, end_row=0, limit=0):
+        """ Import the data rows from start_row up to end_row, and at most limit of them.
+            With a row index the rows are read from the memory map from start_row,
+            otherwise the rows before it are parsed but not imported
+        """
+        if limit:
+            end_row = min(end_row or start_row + limit, start_row + limit)
+        self.end_row = end_row
+        self.row_offset = start_row
+        if self.row_index is not None and (start_row or end_row):
+            header = self.header_count()
+            self.close_csvfile()
+            self.csvfile = self.header_rows(
+                self.stream_rows(
+                    self.read_rows(
+                        self.row_index.reader(
+                            header + start_row, header + end_row if end_row else None
+                        ),
+                        delimiter=self.delimiter,
+                        reader=self.reader,
+                        stream=True,
+                    )
+                )
+            )
+        else:
+            self.skip_rows = start_row
+
+    def header_count(self):
+        """ Number of header rows the import skips """
+        if self.mappings and not self.nameindexes:
+            return 0
+        return 1
+
     def make_row(self, row, csvimportid, index, loglist, clean=True):
         """Create an instance of the model and populate it with the rows data"""
         model_instance = self.model()
         model_instance.csvimport_id = csvimportid
+        msg = ""
+        if not self.plan:
+            self.compile_plan()
 
-        for (column, field, foreignkey) in self.mappings:
-            if self.nameindexes:
-                column = indexes.index(column)
-            else:
-                column = int(column) - 1
-
+        for (column, field, foreignkey, cleaner) in self.plan:
             if foreignkey:
                 if len(row) <= column:
                     msg = (
@@ -315,8 +1093,8 @@ class Command(LabelCommand, CSVParser):
                     '%s.%s = "%s"' % (self.model.__name__, field, row[column])
                 )
             try:
-                if clean:
-                    row[column] = self.type_clean(field, row[column], loglist, index)
+                if clean and cleaner:
+                    row[column] = cleaner(row[column], loglist, index)
             except:
                 pass
             try:
@@ -337,25 +1115,153 @@ class Command(LabelCommand, CSVParser):
 
         return model_instance
 
+    def load_mappings(self, loglist):
+        """ Use the mappings given or else those from the header row """
+        if self.mappings:
+            self.start = 0
+            loglist.append("Manually entered mapping list")
+        else:
+            mappingstr = self.parse_header(self.header)
+            if mappingstr:
+                loglist.append("Mapping from first, header, row of CSV file")
+                self.mappings = self.set_mappings(mappingstr)
+                self.resolve_fkeys()
+        if self.mappings and self.nameindexes:
+            # Header row names are used as the column indexes so skip it
+            self.indexes = self.header
+            self.start = 1
+        return self.mappings
+
+    def compile_values(self, loglist):
+        """ Compile the plan for raw rows, a template tuple of the engine's column values
+            from a model instance with the defaults set, and a list of
+            (value index, row index, foreign key, cleaner, field) for each mapped column.
+            Fields whose value changes from row to row, auto_now dates and callable defaults
+            such as a uuid, are listed in raw_fresh to be evaluated for each row
+        """
+        model_instance = self.model()
+        model_instance.csvimport_id = 0
+        self.set_defaults(model_instance, loglist)
+        self.raw_template = list(self.engine.model_values(model_instance))
+        self.raw_instance = model_instance
+        self.raw_plan = []
+        for (column, field, foreignkey, cleaner) in self.plan:
+            model_field = self.fieldmap.get(field)
+            if model_field in self.engine.fields:
+                self.raw_plan.append(
+                    (self.engine.fields.index(model_field), column, foreignkey, cleaner, model_field)
+                )
+        mapped = [plan[4] for plan in self.raw_plan]
+        defaulted = [default[0] for default in self.defaults]
+        self.raw_fresh = []
+        for position, field in enumerate(self.engine.fields):
+            if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+                # Set on save even over a mapped value, as for model instances
+                self.raw_fresh.append((position, field, True))
+            elif (
+                field.has_default()
+                and callable(field.default)
+                and field not in mapped
+                and field.name not in defaulted
+            ):
+                self.raw_fresh.append((position, field, False))
+        return self.raw_plan
+
+    def make_values(self, row, index, loglist):
+        """ Tuple of the column values for a row, cleaned as make_row does
+            but without creating a model instance
+        """
+        values = list(self.raw_template)
+        for (position, column, foreignkey, cleaner, field) in self.raw_plan:
+            if len(row) <= column:
+                loglist.append(
+                    "row %s: Column %s couldnt be set for row - because the row is not parsable - skipping it"
+                    % (index, field.name)
+                )
+                return None
+            value = row[column]
+            if foreignkey:
+                value = self.insert_fkey(foreignkey, value)
+                value = value.pk if value else None
+            elif self.clean and cleaner:
+                try:
+                    value = cleaner(value, loglist, index)
+                except:
+                    pass
+            try:
+                values[position] = field.get_db_prep_save(value, self.engine.connection)
+            except Exception:
+                loglist.append(
+                    "row %s: Column %s = %s couldnt be set for row" % (index, field.name, value)
+                )
+                return None
+        for (position, field, auto) in self.raw_fresh:
+            value = field.pre_save(self.raw_instance, True) if auto else field.get_default()
+            values[position] = field.get_db_prep_save(value, self.engine.connection)
+        return tuple(values)
+
+    def compile_plan(self):
+        """ Compile the mappings into a list of
+            (row index, field, foreign key, cleaner) for make_row to apply to each row
+        """
+        self.plan = []
+        for (column, field, foreignkey) in self.mappings:
+            try:
+                cleaner = self.get_cleaner(field)
+            except Exception:
+                # Not a model field so it is set on the instance as is
+                cleaner = None
+            self.plan.append((self.column_index(column), field, foreignkey, cleaner))
+        return self.plan
+
+    def column_index(self, column):
+        """ Get the position in the row of a mapped column """
+        if self.nameindexes:
+            return self.indexes.index(column)
+        return int(column) - 1
+
+    def repeat_columns(self):
+        """ Row indexes of the columns that identify a repeated row,
+            the dedupe keys if they are all mapped, otherwise every mapped column
+        """
+        columns = dict((field, column) for (column, field, foreignkey, cleaner) in self.plan)
+        if self.dedupe_keys and all(key in columns for key in self.dedupe_keys):
+            return [columns[key] for key in self.dedupe_keys]
+        return sorted(columns.values())
+
+    def skip_repeats(self, rows, seen, columns):
+        """ Drop numbered rows whose key columns repeat an earlier row of the file,
+            before they are converted or checked against the database
+        """
+        for i, row in rows:
+            key = tuple(row[column] if column < len(row) else None for column in columns)
+            if seen.add(key):
+                yield i, row
+            else:
+                self.repeats_skipped += 1
+
+    def chunk_rows(self, rows):
+        """ Group numbered rows into lists of batch size """
+        size = self.batch_size or CHUNK_SIZE
+        chunk = []
+        for numbered in rows:
+            chunk.append(numbered)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
     def run(self, logid=0):
         """ Run the csvimport """
         loglist = []
-        if self.nameindexes:
-            indexes = self.csvfile.pop(0)
         counter = 0
         if logid:
             csvimportid = logid
         else:
             csvimportid = 0
 
-        if self.mappings:
-            self.start = 0
-            loglist.append("Manually entered mapping list")
-        else:
-            mappingstr = self.parse_header(self.csvfile[0])
-            if mappingstr:
-                loglist.append("Mapping from first, header, row of CSV file")
-                self.mappings = self.set_mappings(mappingstr)
+        self.load_mappings(loglist)
         if not self.mappings:
             if not self.model:
                 loglist.append("Outputting setup message")
@@ -368,27 +1274,133 @@ class Command(LabelCommand, CSVParser):
                 )
                 warn += " - you must add a header field name row to the CSV file or supply a mapping list"
                 loglist.append(warn)
+            self.close_csvfile()
             return loglist
+        self.compile_plan()
+        if self.dedupe_keys and self.dedupe_index in DEDUPE_INDEXES:
+            self.load_key_index()
+        if self.engine_name != "orm":
+            self.engine = get_engine(self.engine_name, self.model)
+            if not self.engine:
+                loglist.append(
+                    "The %s engine does not support %s so rows are bulk created"
+                    % (self.engine_name, self.db_backend)
+                )
+        if self.raw:
+            if not self.engine:
+                self.engine = get_engine("insert", self.model)
+            self.compile_values(loglist)
+
+        # Bulk creates are only deduplicated on dedupe keys
+        if self.deduplicate and self.dedupe_spill and (self.dedupe_keys or not self.bulk):
+            seen = SpillSet(self.dedupe_spill)
+            repeat_columns = self.repeat_columns()
+        else:
+            seen = None
 
         # count before import
         rowcount = self.model.objects.count()
         models = []
-        for i, row in enumerate(self.csvfile[self.start :]):
-            if CSVIMPORT_LOG == "logger":
-                logger.info("Import %s %i", self.model.__name__, counter)
-            counter += 1
-            model_instance = self.make_row(row, csvimportid, i, loglist, self.clean)
-            if self.bulk:
-                models.append(model_instance)
-            else:
-                with transaction.atomic():
-                    try:
-                        self.row_insert(row, model_instance, loglist)
-                    except:
-                        pass
-            # loglist = []
-        if models and self.bulk:
-            models[0].__class__.objects.bulk_create(models)
+        rownums = []
+        snapshot = OrderedDict()
+        rejected = 0
+        try:
+            with loading(self.engine):
+                stop = None
+                if self.end_row:
+                    stop = self.start + self.skip_rows + max(0, self.end_row - self.row_offset)
+                rows = enumerate(
+                    itertools.islice(self.csvfile, self.start + self.skip_rows, stop),
+                    self.row_offset,
+                )
+                if seen is not None:
+                    rows = self.skip_repeats(rows, seen, repeat_columns)
+                for chunk in self.chunk_rows(rows):
+                    if self.fkey_prepass:
+                        self.prefetch_fkeys(chunk)
+                    for i, row in chunk:
+                        self.rows_read = i + 1
+                        if CSVIMPORT_LOG == "logger":
+                            logger.info("Import %s %i", self.model.__name__, counter)
+                        counter += 1
+                        if self.raw:
+                            values = self.make_values(row, i, loglist)
+                            if values is not None:
+                                models.append(values)
+                                rownums.append(i)
+                            if self.batch_size and len(models) >= self.batch_size:
+                                self.bulk_insert(models, loglist, rownums)
+                                models = []
+                                rownums = []
+                            continue
+                        logged = len(loglist)
+                        model_instance = self.make_row(row, csvimportid, i, loglist, self.clean)
+                        if self.sync:
+                            if model_instance:
+                                self.set_defaults(model_instance, loglist)
+                                snapshot[self.conflict_key(model_instance)] = model_instance
+                            if not model_instance or any(
+                                msg.startswith("row ") for msg in loglist[logged:]
+                            ):
+                                rejected += 1
+                        elif self.bulk:
+                            if model_instance:
+                                self.set_defaults(model_instance, loglist)
+                                models.append(model_instance)
+                                rownums.append(i)
+                            if self.batch_size and len(models) >= self.batch_size:
+                                self.bulk_insert(models, loglist, rownums)
+                                models = []
+                                rownums = []
+                        else:
+                            with transaction.atomic():
+                                try:
+                                    self.row_insert(row, model_instance, loglist)
+                                except:
+                                    pass
+                        # loglist = []
+                    if not self.bulk:
+                        # Rows are committed one at a time so checkpoint each chunk
+                        self.save_checkpoint()
+                    if self.progress:
+                        self.progress(self.row_offset + counter)
+                if models:
+                    self.bulk_insert(models, loglist, rownums)
+                if self.sync:
+                    self.sync_snapshot(snapshot, loglist, rejected)
+        finally:
+            self.close_csvfile()
+            if seen is not None:
+                seen.close()
+            if self.row_index is not None:
+                self.row_index.close()
+        if self.repeats_skipped:
+            loglist.append("Skipped %s rows repeated in the file" % self.repeats_skipped)
+        if self.fkey_hits or self.fkey_misses:
+            loglist.append(
+                "Foreign key cache hits %s, misses %s"
+                % (self.fkey_hits, self.fkey_misses)
+            )
+        if self.upserted:
+            loglist.append(
+                "Updated %s existing rows"
+                % max(0, self.upserted - self.model.objects.count() + rowcount)
+            )
+        if self.dedupe_skipped:
+            loglist.append(
+                "Skipped %s duplicate rows matched on %s"
+                % (self.dedupe_skipped, ", ".join(self.dedupe_keys))
+            )
+        if self.batch_size and self.chunk_count:
+            loglist.append(
+                "Committed %s chunks of up to %s rows, average %.3f seconds, slowest %.3f seconds"
+                % (
+                    self.chunk_count,
+                    self.batch_size,
+                    self.chunk_seconds / self.chunk_count,
+                    self.chunk_max,
+                )
+            )
         # count after import
         rowcount = self.model.objects.count() - rowcount
         countmsg = "Imported %s rows to %s" % (rowcount, self.model.__name__)
@@ -407,22 +1419,309 @@ class Command(LabelCommand, CSVParser):
         else:
             return ["No logging"]
 
+    def bulk_insert(self, models, loglist, rownums=None):
+        """ Bulk create a chunk of rows in its own transaction and time the commit """
+        if self.dedupe_keys:
+            models, rownums = self.dedupe_models(models, rownums)
+            if not models:
+                self.save_checkpoint()
+                return
+        self.chunk_count += 1
+        started = time.time()
+        try:
+            # The checkpoint is committed with the rows
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                self.bulk_create(models)
+                self.save_checkpoint()
+        except (DatabaseError, ValueError) as err:
+            if not self.bisect:
+                loglist.append(
+                    "Chunk %s: bulk create of %s rows failed - %s"
+                    % (self.chunk_count, len(models), err)
+                )
+                self.save_checkpoint()
+                return
+            self.bisect_insert(models, rownums or list(range(len(models))), loglist, err)
+            self.save_checkpoint()
+        seconds = time.time() - started
+        self.chunk_seconds += seconds
+        self.chunk_max = max(self.chunk_max, seconds)
+        if CSVIMPORT_LOG == "logger":
+            logger.info(
+                "Chunk %s: committed %s rows in %.3f seconds",
+                self.chunk_count,
+                len(models),
+                seconds,
+            )
+
+    def dedupe_models(self, models, rownums=None):
+        """ Drop the rows whose dedupe key values are already in the table or earlier in the chunk.
+            The table is probed with a query per chunk, filtered on all the key fields
+        """
+        rownums = rownums or list(range(len(models)))
+        fields = [self.fieldmap[key] for key in self.dedupe_keys]
+        attnames = [field.attname for field in fields]
+        keys = [
+            self.dedupe_key(fields, [getattr(model, attname) for attname in attnames])
+            for model in models
+        ]
+        if self.key_index is None:
+            existing = set(self.existing_keys(fields, attnames, keys))
+        else:
+            existing = set(key for key in keys if key in self.key_index)
+            if existing and self.key_index.confirm:
+                existing = set(self.existing_keys(fields, attnames, existing))
+        kept = []
+        keptnums = []
+        for model, rownum, key in zip(models, rownums, keys):
+            if key in existing:
+                self.dedupe_skipped += 1
+                continue
+            existing.add(key)
+            if self.key_index is not None:
+                self.key_index.add(key)
+            kept.append(model)
+            keptnums.append(rownum)
+        return kept, keptnums
+
+    def existing_keys(self, fields, attnames, keys):
+        """ Get a dict of the primary keys of the rows with these keys in the table.
+            Each key is a tuple of values in the order of attnames, as the --dedupe-keys
+            or --conflict-keys are given. A single key field is filtered with IN queries,
+            several with an OR of each key's values so only the matching rows are read
+        """
+        if len(attnames) == 1:
+            values = list(set(key[0] for key in keys if key[0] is not None))
+            queries = [
+                Q(**{attnames[0] + "__in": values[start : start + IN_QUERY_SIZE]})
+                for start in range(0, len(values), IN_QUERY_SIZE)
+            ]
+            if len(values) < len(set(key[0] for key in keys)):
+                queries.append(Q(**{attnames[0] + "__isnull": True}))
+        else:
+            keys = list(set(keys))
+            # Each key is a query parameter per field
+            size = max(1, IN_QUERY_SIZE // len(attnames))
+            queries = []
+            for start in range(0, len(keys), size):
+                query = Q()
+                for key in keys[start : start + size]:
+                    query |= Q(
+                        **dict(
+                            (attname + "__isnull", True) if value is None else (attname, value)
+                            for attname, value in zip(attnames, key)
+                        )
+                    )
+                queries.append(query)
+        existing = {}
+        for query in queries:
+            matches = self.model.objects.filter(query).values_list("pk", *attnames)
+            for match in matches:
+                existing[self.dedupe_key(fields, match[1:])] = match[0]
+        return existing
+
+    def load_key_index(self):
+        """ Stream the dedupe key values in the table once into an in memory index """
+        fields = [self.fieldmap[key] for key in self.dedupe_keys]
+        attnames = [field.attname for field in fields]
+        self.key_index = DEDUPE_INDEXES[self.dedupe_index](
+            2 * self.model.objects.count(), self.dedupe_error_rate
+        )
+        for values in self.model.objects.values_list(*attnames).iterator():
+            self.key_index.add(self.dedupe_key(fields, values))
+        return self.key_index
+
+    def dedupe_key(self, fields, values):
+        """ Tuple of key values as the model fields python types,
+            so cleaned row values match those loaded from the database
+        """
+        key = []
+        for field, value in zip(fields, values):
+            try:
+                value = field.to_python(value)
+            except Exception:
+                pass
+            key.append(value)
+        return tuple(key)
+
+    def bulk_create(self, models):
+        """ Bulk create rows in a transaction of their own """
+        with transaction.atomic():
+            if self.conflict_keys:
+                self.upserted += self.bulk_upsert(models)
+            elif self.raw:
+                self.engine.write(models)
+            elif self.engine:
+                self.engine.write([self.engine.model_values(model) for model in models])
+            else:
+                # Chunks are already batch size, so the backend sets the rows per query
+                self.model.objects.bulk_create(models)
+
+    def bulk_upsert(self, models):
+        """ Bulk create rows, updating those whose conflict keys are already in the table.
+            Uses bulk create with update on conflict if the django version and backend support it,
+            otherwise queries the existing keys then does a bulk update and a bulk create.
+            Returns the number of rows upserted
+        """
+        fields = [self.fieldmap[key] for key in self.conflict_keys]
+        attnames = [field.attname for field in fields]
+        # Rows later in the file win if a key is repeated
+        latest = OrderedDict()
+        for model in models:
+            latest[self.conflict_key(model)] = model
+        models = list(latest.values())
+        update_fields = self.upsert_fields()
+        if self.engine and self.engine.upserts:
+            self.engine.upsert(
+                [self.engine.model_values(model) for model in models],
+                fields,
+                [self.model._meta.get_field(name) for name in update_fields],
+            )
+            return len(models)
+        features = connections[router.db_for_write(self.model)].features
+        if not update_fields:
+            if getattr(features, "supports_ignore_conflicts", False):
+                self.model.objects.bulk_create(models, ignore_conflicts=True)
+                return len(models)
+        elif StrictVersion(django.get_version()) >= StrictVersion("4.1") and getattr(
+            features, "supports_update_conflicts_with_target", False
+        ):
+            self.model.objects.bulk_create(
+                models,
+                update_conflicts=True,
+                unique_fields=[field.name for field in fields],
+                update_fields=update_fields,
+            )
+            return len(models)
+        existing = self.existing_keys(fields, attnames, latest.keys())
+        updates = []
+        creates = []
+        for key, model in latest.items():
+            if key in existing:
+                model.pk = existing[key]
+                updates.append(model)
+            else:
+                creates.append(model)
+        if updates and update_fields:
+            self.model.objects.bulk_update(updates, update_fields)
+        if creates:
+            self.model.objects.bulk_create(creates)
+        return len(models)
+
+    def conflict_key(self, model):
+        """ Tuple of the conflict key values of a row """
+        fields = [self.fieldmap[key] for key in self.conflict_keys]
+        return self.dedupe_key(fields, [getattr(model, field.attname) for field in fields])
+
+    def sync_snapshot(self, snapshot, loglist, rejected=0):
+        """ Diff the rows of the file, keyed on their conflict keys, against the table
+            in one pass over it, then bulk apply the inserts, updates and deletes in batches.
+            Rows are only deleted if every line of the file was read cleanly, since a rejected
+            line would otherwise delete the row it was meant to sync
+        """
+        if not snapshot:
+            loglist.append("Sync found no rows in the file so nothing is deleted")
+            return
+        fields = [self.fieldmap[key] for key in self.conflict_keys]
+        update_fields = self.upsert_fields()
+        compare = [self.model._meta.get_field(name) for name in update_fields]
+        keyend = len(fields) + 1
+        updates = []
+        deletes = []
+        unchanged = 0
+        rows = self.model.objects.values_list(
+            "pk", *[field.attname for field in fields + compare]
+        )
+        for row in rows.iterator():
+            model = snapshot.pop(self.dedupe_key(fields, row[1:keyend]), None)
+            if model is None:
+                deletes.append(row[0])
+            elif self.dedupe_key(compare, row[keyend:]) == self.dedupe_key(
+                compare, [getattr(model, field.attname) for field in compare]
+            ):
+                unchanged += 1
+            else:
+                model.pk = row[0]
+                updates.append(model)
+        inserts = list(snapshot.values())
+        if rejected:
+            loglist.append(
+                "Sync left %s rows missing from the file undeleted since %s lines were rejected"
+                % (len(deletes), rejected)
+            )
+            deletes = []
+        size = self.batch_size or CHUNK_SIZE
+        inserted = updated = 0
+        for start in range(0, len(inserts), size):
+            batch = inserts[start : start + size]
+            try:
+                with transaction.atomic():
+                    self.model.objects.bulk_create(batch)
+                inserted += len(batch)
+            except (DatabaseError, ValueError) as err:
+                loglist.append("Sync bulk create of %s rows failed - %s" % (len(batch), err))
+        for start in range(0, len(updates), size):
+            batch = updates[start : start + size]
+            try:
+                with transaction.atomic():
+                    self.model.objects.bulk_update(batch, update_fields)
+                updated += len(batch)
+            except (DatabaseError, ValueError) as err:
+                loglist.append("Sync bulk update of %s rows failed - %s" % (len(batch), err))
+        for start in range(0, len(deletes), IN_QUERY_SIZE):
+            with transaction.atomic():
+                self.model.objects.filter(
+                    pk__in=deletes[start : start + IN_QUERY_SIZE]
+                ).delete()
+        loglist.append(
+            "Sync inserted %s, updated %s, deleted %s and left %s rows unchanged"
+            % (inserted, updated, len(deletes), unchanged)
+        )
+
+    def upsert_fields(self):
+        """ Names of the fields an upsert updates """
+        if self.update_fields:
+            names = self.update_fields
+        else:
+            names = [field for (column, field, foreignkey) in self.mappings + self.defaults]
+        keys = [self.fieldmap[key].name for key in self.conflict_keys]
+        fields = []
+        for name in names:
+            field = self.fieldmap.get(name)
+            if field and not field.primary_key and field.name not in keys + fields:
+                fields.append(field.name)
+        return fields
+
+    def split_fields(self, fields):
+        """ List of the field names in a comma separated string """
+        return [field.strip() for field in (fields or "").split(",") if field.strip()]
+
+    def bisect_insert(self, models, rownums, loglist, err):
+        """ Retry a failed bulk create by splitting it in half and retrying each half,
+            recursing until the failures are single rows which are logged and left out.
+            So k bad rows in a chunk of n cost O(k log n) inserts rather than n row inserts
+        """
+        if len(models) == 1:
+            loglist.append(
+                "row %s: line %s could not be inserted - %s"
+                % (rownums[0], rownums[0] + self.start + 1, err)
+            )
+            return
+        half = len(models) // 2
+        for part, partnums in (
+            (models[:half], rownums[:half]),
+            (models[half:], rownums[half:]),
+        ):
+            try:
+                self.bulk_create(part)
+            except (DatabaseError, ValueError) as parterr:
+                self.bisect_insert(part, partnums, loglist, parterr)
+
     def row_insert(self, row, model_instance, loglist):
         """ Insert a row - separate function for transaction wrapping """
         msg = ""
         if model_instance:
-            if self.defaults:
-                for (field, value, foreignkey) in self.defaults:
-                    value = self.type_clean(field, value, loglist)
-                    try:
-                        done = model_instance.getattr(field)
-                    except:
-                        done = False
-                    if not done:
-                        if foreignkey:
-                            value = self.insert_fkey(foreignkey, value)
-                    if value:
-                        model_instance.__setattr__(field, value)
+            self.set_defaults(model_instance, loglist)
 
             if self.deduplicate:
                 matchdict = {}
@@ -435,11 +1734,11 @@ class Command(LabelCommand, CSVParser):
                     pass
             try:
                 importing_csv.send(
-                    sender=model_instance, row=dict(zip(self.csvfile[:1][0], row))
+                    sender=model_instance, row=dict(zip(self.header, row))
                 )
                 model_instance.save()
                 imported_csv.send(
-                    sender=model_instance, row=dict(zip(self.csvfile[:1][0], row))
+                    sender=model_instance, row=dict(zip(self.header, row))
                 )
             except DatabaseError as err:
                 try:
@@ -461,84 +1760,154 @@ class Command(LabelCommand, CSVParser):
                 for line in loglist:
                     logger.info(line)
 
+    def set_defaults(self, model_instance, loglist):
+        """ Set the default values for fields """
+        for (field, value, foreignkey) in self.defaults:
+            value = self.type_clean(field, value, loglist)
+            try:
+                done = model_instance.getattr(field)
+            except:
+                done = False
+            if not done:
+                if foreignkey:
+                    value = self.insert_fkey(foreignkey, value)
+            if value:
+                model_instance.__setattr__(field, value)
+
     def type_clean(self, field, value, loglist, row=0):
         """ Data value clean up - type formatting"""
-        if not self.fieldmap.get(field):
-            raise Exception(
-                "Fieldmap is not populated for %s -\n%s" % (field, self.fieldmap)
-            )
-        field_type = self.fieldmap.get(field).get_internal_type()
+        return self.get_cleaner(field)(value, loglist, row)
 
-        try:
-            value = value.strip()
-        except AttributeError:
-            pass
+    def get_cleaner(self, field):
+        """ Get the compiled function that cleans values for a field """
+        cleaner = self.cleaners.get(field)
+        if not cleaner:
+            if not self.fieldmap.get(field):
+                raise Exception(
+                    "Fieldmap is not populated for %s -\n%s" % (field, self.fieldmap)
+                )
+            field_type = self.fieldmap.get(field).get_internal_type()
+            cleaner = self.cleaners[field] = self.make_cleaner(field, field_type)
+        return cleaner
+
+    def make_cleaner(self, field, field_type):
+        """ Build a function that cleans a value for one field,
+            so the field type and db backend checks are done once here rather than per cell
+        """
+        smallint_db = self.db_backend in SMALLINT_DBS
+
+        def clean_text(value, loglist, row=0):
+            try:
+                return value.strip()
+            except AttributeError:
+                return value
 
         # Tidy up boolean data
         if field_type in BOOLEAN:
-            value = value in BOOLEAN_TRUE
             # sqlite fix since it just uses int under the hood
-            if self.db_backend in SMALLINT_DBS:
-                if value:
-                    value = 1
-                else:
-                    value = 0
+            if smallint_db:
+                true, false = 1, 0
+            else:
+                true, false = True, False
+
+            def clean_boolean(value, loglist, row=0):
+                if clean_text(value, loglist, row) in BOOLEAN_TRUE:
+                    return true
+                return false
+
+            return clean_boolean
 
         # Tidy up numeric data
         if field_type in NUMERIC:
-            if not value:
-                value = 0
-            else:
+
+            def clean_number(value, loglist, row=0):
+                value = clean_text(value, loglist, row)
+                if not value:
+                    return 0
                 try:
-                    value = float(value)
+                    return float(value)
                 except:
                     loglist.append(
                         "row %s: Column %s = %s is not a number so is set to 0"
                         % (row, field, value)
                     )
-                    value = 0
-            if field_type in INTEGER:
+                    return 0
+
+            if field_type not in INTEGER:
+                return clean_number
+            positive = field_type.startswith("Positive")
+
+            def clean_integer(value, loglist, row=0):
+                value = clean_number(value, loglist, row)
                 # 1e+28 = 9999999999999999583119736832L
                 if value > 9223372036854775807:
                     intmsg = (
                         "row %s: Column %s = %s more than the max integer 9223372036854775807"
                         % (row, field, value)
                     )
-                    if self.db_backend in SMALLINT_DBS:
+                    if smallint_db:
                         intmsg += " sqlite may error with big integers so rounded down"
                         value = 9223372036854775807
                     loglist.append(intmsg)
-                if str(value).lower() in ("nan", "inf", "+inf", "-inf"):
+                if value != value or value in (float("inf"), float("-inf")):
                     loglist.append(
                         "row %s: Column %s = %s is not an integer so is set to 0"
                         % (row, field, value)
                     )
-                    value = 0
+                    return 0
                 value = int(value)
-                if value < 0 and field_type.startswith("Positive"):
+                if value < 0 and positive:
                     loglist.append(
                         "row %s: Column %s = %s, less than zero so set to 0"
                         % (row, field, value)
                     )
-                    value = 0
+                    return 0
+                return value
+
+            return clean_integer
+
         # date data - remove the date if it doesn't convert so null=True can work
         if field_type in DATE:
-            datevalue = None
-            try:
-                datevalue = datetime(value)
-            except:
+            # The format found for this column, tried first for the following rows
+            found = [None, None]
+
+            def parse_date(value):
+                datefmt, parser = found
+                if parser:
+                    try:
+                        return parser(value)
+                    except (TypeError, ValueError):
+                        pass
+                elif datefmt:
+                    try:
+                        return datetime.strptime(value, datefmt)
+                    except (TypeError, ValueError):
+                        pass
+                # New column or a miss so look for the format again
                 for datefmt in CSV_DATE_INPUT_FORMATS:
                     try:
                         datevalue = datetime.strptime(value, datefmt)
                     except:
-                        pass
+                        continue
+                    if parse_isodate and datefmt in ISO_DATE_FORMATS:
+                        found[:] = [datefmt, parse_isodate]
+                    else:
+                        found[:] = [datefmt, None]
+                    return datevalue
+                return None
 
-            if datevalue:
-                value = timezone.make_aware(datevalue, CURRENT_TIMEZONE)
-            else:
+            def clean_date(value, loglist, row=0):
+                datevalue = parse_date(clean_text(value, loglist, row))
+                if datevalue:
+                    if timezone.is_aware(datevalue):
+                        return datevalue
+                    return timezone.make_aware(datevalue, CURRENT_TIMEZONE)
                 # loglist.append('row %s: Column %s = %s not date format' % (i, field, value))
-                value = None
-        return value
+                return None
+
+            return clean_date
+
+        return clean_text
 
     def parse_header(self, headlist):
         """ Parse the list of headings and match with self.fieldmap """
@@ -568,31 +1937,121 @@ class Command(LabelCommand, CSVParser):
             return mappingstr
         return ""
 
-    def insert_fkey(self, foreignkey, rowcol):
-        """ Add fkey if not present
-            If there is corresponding data in the model already,
-            we do not need to add more, since we are dealing with
-            foreign keys, therefore foreign data
-        """
-        fk_key, fk_field = foreignkey
-        if fk_key and fk_field:
+    def resolve_fkeys(self):
+        """ Look up the model for each foreign key mapping once rather than per cell """
+        for (column, field, foreignkey) in self.mappings + self.defaults:
+            if foreignkey:
+                self.get_fkey_model(foreignkey)
+
+    def get_fkey_model(self, foreignkey):
+        """ Get the model for a foreign key mapping (Model|field) """
+        fk_key = foreignkey[0]
+        if fk_key not in self.fkey_models:
             # Allow users to specify app label for fk model if they want
             if fk_key.find(".") > -1:
-                new_app_label, fk_key = fk_key.split(".")
+                new_app_label, model = fk_key.split(".")
             else:
+                model = fk_key
                 try:
                     new_app_label = ContentType.objects.get(model=fk_key).app_label
                 except:
                     new_app_label = self.app_label
-            fk_model = get_model(new_app_label, fk_key)
-            matches = fk_model.objects.filter(**{fk_field + "__exact": rowcol})
+            self.fkey_models[fk_key] = get_model(new_app_label, model)
+        return self.fkey_models[fk_key]
+
+    def load_fkeys(self, fk_model, fk_field, values):
+        """ Get a dict of the related rows that exist for a list of foreign key values """
+        found = {}
+        for start in range(0, len(values), IN_QUERY_SIZE):
+            matches = fk_model.objects.filter(
+                **{fk_field + "__in": values[start : start + IN_QUERY_SIZE]}
+            )
+            for instance in matches:
+                found.setdefault(getattr(instance, fk_field), instance)
+        return found
+
+    def prefetch_fkeys(self, chunk):
+        """ Pre-pass over a chunk of rows that loads the existing related rows for each
+            foreign key mapping in one query, bulk creates the missing ones
+            and puts them all in the foreign key cache ready for make_row
+        """
+        for (column, field, foreignkey) in self.mappings:
+            if not foreignkey:
+                continue
+            fk_model = self.get_fkey_model(foreignkey)
+            fk_field = foreignkey[1]
+            index = self.column_index(column)
+            values = set()
+            for i, row in chunk:
+                if len(row) > index:
+                    try:
+                        values.add(self.fkey_value(fk_model, fk_field, row[index]))
+                    except ValidationError:
+                        # Left for make_row to report against its row
+                        pass
+            values = list(values)
+            found = self.load_fkeys(fk_model, fk_field, values)
+            missing = [value for value in values if value not in found]
+            if missing:
+                with transaction.atomic():
+                    fk_model.objects.bulk_create(
+                        [fk_model(**{fk_field: value}) for value in missing],
+                        batch_size=IN_QUERY_SIZE,
+                    )
+                # bulk create does not set the primary keys for every backend
+                found.update(self.load_fkeys(fk_model, fk_field, missing))
+            for value, instance in found.items():
+                self.cache_fkey((fk_model, fk_field, value), instance)
 
-            if not matches:
-                key = fk_model()
-                key.__setattr__(fk_field, rowcol)
-                key.save()
+    def fkey_value(self, fk_model, fk_field, value):
+        """ Value in the form of the related field, as the rows it finds return it,
+            so a value read as text matches them and is cached under one key
+        """
+        return fk_model._meta.get_field(fk_field).to_python(value)
+
+    def cache_fkey(self, key, instance):
+        """ Add to the foreign key cache, dropping the least recently used if it is full """
+        if not self.fkey_cache_size:
+            return
+        self.fkey_cache[key] = instance
+        if len(self.fkey_cache) > self.fkey_cache_size:
+            self.fkey_cache.popitem(last=False)
 
-            rowcol = fk_model.objects.filter(**{fk_field + "__exact": rowcol})[0]
+    def insert_fkey(self, foreignkey, rowcol):
+        """ Add fkey if not present
+            If there is corresponding data in the model already,
+            we do not need to add more, since we are dealing with
+            foreign keys, therefore foreign data
+        """
+        fk_key, fk_field = foreignkey
+        if fk_key and fk_field:
+            fk_model = self.get_fkey_model(foreignkey)
+            try:
+                rowcol = self.fkey_value(fk_model, fk_field, rowcol)
+            except ValidationError:
+                pass
+            key = (fk_model, fk_field, rowcol)
+            instance = self.fkey_cache.pop(key, None)
+            if instance is not None:
+                # put it back as the most recently used
+                self.fkey_cache[key] = instance
+                self.fkey_hits += 1
+                return instance
+            self.fkey_misses += 1
+            matches = fk_model.objects.filter(**{fk_field + "__exact": rowcol})[:1]
+            if matches:
+                instance = matches[0]
+                self.cache_fkey(key, instance)
+            else:
+                instance = fk_model()
+                instance.__setattr__(fk_field, rowcol)
+                instance.save()
+                if transaction.get_connection().in_atomic_block:
+                    # Do not cache a new key that could still be rolled back
+                    transaction.on_commit(partial(self.cache_fkey, key, instance))
+                else:
+                    self.cache_fkey(key, instance)
+            rowcol = instance
         return rowcol
 
     def check_fkey(self, key, field):
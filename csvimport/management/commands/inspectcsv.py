@@ -44,7 +44,6 @@ class Command(LabelCommand, CSVParser):
         super(Command, self).__init__()
         self.csvfile = []
         self.charset = ''
-        self.filehandle = None
         self.makemodel = ''
         self.errors = []
 
@@ -104,9 +103,10 @@ class Command(LabelCommand, CSVParser):
             self.modelname = ''
             return
         try:
-            table_set = any_tableset(self.filehandle)
-            row_set = table_set.tables[0]
-            types = type_guess(row_set.sample)
+            with open(self.datafile, 'rb') as filehandle:
+                table_set = any_tableset(filehandle)
+                row_set = table_set.tables[0]
+                types = type_guess(row_set.sample)
             types = [str(typeobj) for typeobj in types]
             # If the header has more cols than the data has cols - ignore the end ones
             if len(cols) > len(types):
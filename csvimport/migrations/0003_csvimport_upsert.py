@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0002_test_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='conflict_keys',
+            field=models.CharField(blank=True, help_text='Enter the fields that identify an existing row\n                                        to update it rather than create a row, eg. "code_share,code_org"', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='update_fields',
+            field=models.CharField(blank=True, help_text='Fields updated in existing rows, default all the mapped fields', max_length=255),
+        ),
+    ]
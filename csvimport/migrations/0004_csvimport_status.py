@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0003_csvimport_upsert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='status',
+            field=models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='done', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='progress',
+            field=models.PositiveIntegerField(default=0, help_text='Rows read so far'),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
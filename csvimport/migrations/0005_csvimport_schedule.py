@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0004_csvimport_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='priority',
+            field=models.IntegerField(default=0, help_text='Queued imports with a higher priority run first'),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='wait_seconds',
+            field=models.FloatField(blank=True, help_text='Time spent queued', null=True),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='run_seconds',
+            field=models.FloatField(blank=True, help_text='Time spent importing', null=True),
+        ),
+        migrations.CreateModel(
+            name='ImportLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('locked_at', models.DateTimeField(auto_now_add=True)),
+                ('csvimport', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='csvimport.CSVImport')),
+            ],
+        ),
+    ]
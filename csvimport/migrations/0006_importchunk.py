@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0005_csvimport_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='chunks',
+            field=models.PositiveIntegerField(default=0, help_text='Chunks the file is split into for workers to lease'),
+        ),
+        migrations.CreateModel(
+            name='ImportChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('part', models.PositiveIntegerField()),
+                ('start', models.BigIntegerField()),
+                ('end', models.BigIntegerField()),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=16)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('lease_until', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('error_log', models.TextField(blank=True)),
+                ('csvimport', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='csvimport.CSVImport')),
+            ],
+            options={
+                'unique_together': {('csvimport', 'part')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0006_importchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='checkpoint_row',
+            field=models.PositiveIntegerField(default=0, help_text='Rows committed at the last checkpoint'),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='checkpoint_offset',
+            field=models.BigIntegerField(default=0, help_text='Byte offset in the file after those rows'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0007_csvimport_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlock',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, help_text='End of the lease of the chunk the lock is held for', null=True),
+        ),
+    ]
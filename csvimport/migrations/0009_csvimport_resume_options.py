@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0008_importlock_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='defaults',
+            field=models.TextField(blank=True, help_text='Defaults the import was run with, to resume it'),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='dedupe_keys',
+            field=models.CharField(blank=True, help_text='Fields that identify a duplicate row, to resume the import', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='engine',
+            field=models.CharField(default='orm', help_text='Engine that loads the rows', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='raw',
+            field=models.BooleanField(default=False, help_text='Rows are loaded as tuples rather than model instances'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0009_csvimport_resume_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='delimiter',
+            field=models.CharField(default=',', help_text='Delimiter of the CSV file', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='csvimport',
+            name='clean_values',
+            field=models.BooleanField(default=True, help_text='Invalid numeric and date values are changed to valid ones'),
+        ),
+    ]
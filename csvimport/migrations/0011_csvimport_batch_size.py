@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csvimport', '0010_csvimport_parse_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvimport',
+            name='batch_size',
+            field=models.PositiveIntegerField(default=0, help_text='Rows bulk created in each transaction, 0 for one at a time'),
+        ),
+    ]
@@ -8,6 +8,8 @@ import re
 
 fs = FileSystemStorage(location=settings.MEDIA_ROOT)
 CHOICES = (('manual', 'manual'), ('cronjob', 'cronjob'))
+STATUSES = (('queued', 'queued'), ('running', 'running'),
+            ('done', 'done'), ('failed', 'failed'))
 MODELS = []
 
 
@@ -58,6 +60,30 @@ class CSVImport(models.Model):
     import_date = models.DateField(auto_now=True)
     import_user = models.CharField(max_length=255, default='anonymous',
                                    help_text='User id as text', blank=True)
+    conflict_keys = models.CharField(max_length=255, blank=True,
+                                     help_text='''Enter the fields that identify an existing row
+                                        to update it rather than create a row, eg. "code_share,code_org"''')
+    update_fields = models.CharField(max_length=255, blank=True,
+                                     help_text='Fields updated in existing rows, default all the mapped fields')
+    status = models.CharField(max_length=16, default='done', choices=STATUSES)
+    progress = models.PositiveIntegerField(default=0, help_text='Rows read so far')
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    priority = models.IntegerField(default=0, help_text='Queued imports with a higher priority run first')
+    wait_seconds = models.FloatField(null=True, blank=True, help_text='Time spent queued')
+    run_seconds = models.FloatField(null=True, blank=True, help_text='Time spent importing')
+    chunks = models.PositiveIntegerField(default=0, help_text='Chunks the file is split into for workers to lease')
+    checkpoint_row = models.PositiveIntegerField(default=0, help_text='Rows committed at the last checkpoint')
+    checkpoint_offset = models.BigIntegerField(default=0, help_text='Byte offset in the file after those rows')
+    defaults = models.TextField(blank=True, help_text='Defaults the import was run with, to resume it')
+    dedupe_keys = models.CharField(max_length=255, blank=True,
+                                   help_text='Fields that identify a duplicate row, to resume the import')
+    engine = models.CharField(max_length=16, default='orm', help_text='Engine that loads the rows')
+    raw = models.BooleanField(default=False, help_text='Rows are loaded as tuples rather than model instances')
+    delimiter = models.CharField(max_length=8, default=',', help_text='Delimiter of the CSV file')
+    clean_values = models.BooleanField(default=True, help_text='Invalid numeric and date values are changed to valid ones')
+    batch_size = models.PositiveIntegerField(default=0, help_text='Rows bulk created in each transaction, 0 for one at a time')
 
     def error_log_html(self):
         return re.sub('\n', '<br/>', self.error_log)
@@ -72,3 +98,31 @@ class ImportModel(models.Model):
     csvimport = models.ForeignKey(CSVImport, on_delete=True)
     numeric_id = models.PositiveIntegerField()
     natural_key = models.CharField(max_length=100)
+
+
+class ImportLock(models.Model):
+    """ Advisory lock on an import slot, held while an import runs.
+        The unique name means only one import can hold a slot on any database
+    """
+    name = models.CharField(max_length=255, unique=True)
+    csvimport = models.ForeignKey(CSVImport, null=True, blank=True, on_delete=models.CASCADE)
+    locked_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True,
+                                      help_text='End of the lease of the chunk the lock is held for')
+
+
+class ImportChunk(models.Model):
+    """ Record aligned byte range of the file of a CSVImport, leased by a worker to import it """
+    csvimport = models.ForeignKey(CSVImport, on_delete=models.CASCADE)
+    part = models.PositiveIntegerField()
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
+    status = models.CharField(max_length=16, default='queued', choices=STATUSES)
+    worker = models.CharField(max_length=255, blank=True)
+    lease_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    rows = models.PositiveIntegerField(default=0)
+    error_log = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('csvimport', 'part')
@@ -1,12 +1,56 @@
 """ Core CSV parser class that is used by the management commands """
 import os
+import mmap
 import re
 import csv
+import io
 import sys
 import codecs
-import re
+import itertools
 pyversion = sys.version_info[0]  # python 2 or 3
 
+CHARSET_DETECTORS = ('chardet', 'cchardet', 'charset_normalizer')
+CHARSET_SAMPLE_BYTES = 1024 * 1024  # 0 to detect the charset from the whole file
+BLOCK_SIZE = 64 * 1024
+
+
+def scan_records(data, offset=0, quotechar=b'"', delimiter=b','):
+    """ Yield the (start, end) byte offsets of each record of a buffer from a record boundary
+        offset, the end being after its line end. Quotes follow the csv excel dialect, a quote
+        only opens a quoted field at the start of a field, where line ends are part of the field
+        and a doubled quote is escaped. Blank lines are skipped, as the csv reader skips them
+    """
+    size = len(data)
+    special = re.compile(b'[\r\n' + re.escape(quotechar) + b']')
+    start = pos = offset
+    while start < size:
+        match = special.search(data, pos)
+        if match is None:
+            yield start, size
+            return
+        found = match.start()
+        char = data[found:found + 1]
+        if char == quotechar:
+            pos = found + 1
+            if found == start or data[found - len(delimiter):found] == delimiter:
+                # Skip to the quote that closes the field
+                while True:
+                    close = data.find(quotechar, pos)
+                    if close < 0:
+                        yield start, size
+                        return
+                    pos = close + 1
+                    if data[pos:pos + 1] != quotechar:
+                        break
+                    pos += 1
+            continue
+        end = found + 1
+        if char == b'\r' and data[end:end + 1] == b'\n':
+            end += 1
+        if found > start:
+            yield start, end
+        start = pos = end
+
 
 class CSVParser(object):
     """ Open a CSV file, check its encoding and parse it into memory
@@ -14,8 +58,12 @@ class CSVParser(object):
     """
 
     csvfile = []
+    datafile = ''
+    header = []
     charset = ''
-    filehandle = None
+    delimiter = ','
+    charset_detector = 'chardet'
+    charset_sample_bytes = CHARSET_SAMPLE_BYTES
     check_cols = False
     string_types = (type(u''), type(''))
 
@@ -25,6 +73,7 @@ class CSVParser(object):
             we'll just transform it.
             Also do optional column count consistency check here
         """
+        rows = list(rows)
         if rows and self.check_cols:
             rowlen = 0
             for row in rows:
@@ -36,90 +85,293 @@ class CSVParser(object):
                                       But you have requested column count checking - so no data has been imported
                                    ''')
                         return []
-        return list(rows)
-
-    def open_csvfile(self, datafile, delimiter=',', reader=True):
-        """ Detect file encoding and open appropriately """
-        self.filehandle = open(datafile, 'rb')
-        if not self.charset:
-            import chardet
-            diagnose = chardet.detect(self.filehandle.read())
-            self.charset = diagnose['encoding']
-        rows = []
-        if reader:
-            try:
-                csvfile = codecs.open(datafile, 'r', self.charset)
-            except IOError:
-                self.error('Could not open specified csv file, %s, or it does not exist' % datafile, 0)
+        return rows
+
+    def stream_rows(self, rows):
+        """ Generator version of list_rows so the whole file is never held in memory
+            The column count check can only stop the import at the first inconsistent row
+            since the preceding rows have already been passed on
+        """
+        rowlen = 0
+        for count, row in enumerate(rows):
+            if self.check_cols:
+                if not rowlen:
+                    rowlen = len(row)
+                elif rowlen != len(row):
+                    self.error('''Sorry you have inconsistent numbers of cols in your CSV rows
+                                  But you have requested column count checking - so import stopped at row %s
+                               ''' % count)
+                    return
+            yield row
+
+    def chain_rows(self, first, rows):
+        """ Put a row taken off the front of a generator back on again
+            closing the generator with this one so its file handle is closed too
+        """
+        try:
+            yield first
+            for row in rows:
+                yield row
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+
+    def lookahead(self, rows):
+        """ Take the first row from an iterator so that errors in it surface here
+            then chain it back on - returns None for no rows
+        """
+        rows = iter(rows)
+        for first in rows:
+            return self.chain_rows(first, rows)
+        return None
+
+    def get_header(self):
+        """ Get the first row without consuming it from a streamed csvfile """
+        if isinstance(self.csvfile, list):
+            self.header = self.csvfile[0] if self.csvfile else []
+        else:
+            rows = self.lookahead(self.csvfile)
+            if rows:
+                self.header = next(rows)
+                self.csvfile = self.chain_rows(self.header, rows)
             else:
+                self.header = []
+                self.csvfile = []
+        return self.header
+
+    def close_csvfile(self):
+        """ Close the file behind a streamed csvfile that has not been used up """
+        close = getattr(self.csvfile, 'close', None)
+        if close:
+            close()
+
+    def open_csvfile(self, datafile, delimiter=',', reader=True, stream=False):
+        """ Detect file encoding and open appropriately
+            If stream is True return a generator of rows rather than a list
+        """
+        self.datafile = datafile
+        try:
+            filehandle = open(datafile, 'rb')
+        except IOError:
+            self.error('Could not open specified csv file, %s, or it does not exist' % datafile, 0)
+        rows = self.read_rows(filehandle, delimiter=delimiter, reader=reader, stream=stream)
+        if stream:
+            return self.stream_rows(rows)
+        return self.list_rows(rows)
+
+    def read_rows(self, filehandle, delimiter=',', reader=True, stream=False):
+        """ Detect the charset from a leading sample then decode and parse the file,
+            including that sample, in a single pass over the one file handle.
+            The file is closed when the rows are used up or the generator is closed.
+        """
+        with filehandle:
+            # A charset that was passed in is used as is, a detected one may be redetected
+            redetect = not self.charset
+            sample = list(self.sample_blocks(filehandle))
+            if not self.charset:
+                self.charset = self.detect_charset(sample)
+            try:
+                codecs.lookup(self.charset)
+            except LookupError:
+                self.error('Unknown charset %s for csv file' % self.charset, 0)
+            rows = []
+            if reader:
                 try:
-                    csvgenerator = self.charset_csv_reader(csv_data=csvfile, charset=self.charset, delimiter=delimiter)
-                    rows = [row for row in csvgenerator]
-                    return self.list_rows(rows)
+                    if pyversion == 3:
+                        csvfile = self.text_lines(itertools.chain(sample, self.file_blocks(filehandle)),
+                                                  self.charset, redetect)
+                    else:
+                        filehandle.seek(0)
+                        csvfile = codecs.getreader(self.charset)(filehandle)
+                    rows = self.charset_csv_reader(csv_data=csvfile, charset=self.charset, delimiter=delimiter)
+                    if stream:
+                        # Only the first row can be tested before committing to the reader
+                        rows = self.lookahead(rows)
+                    else:
+                        rows = list(rows)
                 except:
-                    pass
-        # Sometimes encoding is too mashed to be able to open the file as text with csv_reader
-        # ... especially in Python 3 - its a lot stricter
-        # so reopen as raw unencoded and just try and get lines out one by one
-        output = []
-        count = 0
-        expression = r"""(['"]*)(.*?)\1(""" + delimiter + r"""|$)"""
-        csvsplit = re.compile(expression)
-        if not rows:
-            content = None
+                    rows = []
+            # Sometimes encoding is too mashed to be able to open the file as text with csv_reader
+            # ... especially in Python 3 - its a lot stricter
+            # so go back to the start and just try and get lines out one by one
+            if not rows:
+                filehandle.seek(0)
+                rows = self.split_rows(self.file_blocks(filehandle), delimiter=delimiter,
+                                       charset=self.charset, redetect=redetect)
+            for row in rows:
+                yield row
+
+    def file_blocks(self, filehandle):
+        """ Yield blocks from the file handle until the end of the file """
+        while True:
+            block = filehandle.read(BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+    def sample_blocks(self, filehandle, limit=None):
+        """ Yield blocks from the start of the file up to the charset sample size """
+        if limit is None:
+            limit = self.charset_sample_bytes
+        size = 0
+        while not limit or size < limit:
+            block = filehandle.read(min(BLOCK_SIZE, limit - size) if limit else BLOCK_SIZE)
+            if not block:
+                break
+            size += len(block)
+            yield block
+
+    def detect_charset(self, blocks):
+        """ Guess the charset from an iterable of byte blocks
+            chardet, or the faster cchardet, are fed incrementally and stop once confident
+            charset_normalizer needs the whole sample at once
+        """
+        detector = self.charset_detector or 'chardet'
+        if detector not in CHARSET_DETECTORS:
+            self.error('Unknown charset detector %s so using chardet' % detector)
+            detector = 'chardet'
+        if detector == 'charset_normalizer':
             try:
-                with open(datafile, 'rb') as content_file:
-                    content = content_file.readlines()
-            except:
-                self.loglist.append('Failed to open file %s' % datafile)
-            if type(content) not in self.string_types and len(content) == 1:
-                content = content[0]
-            content_type = type(content)
-
-            if content_type in self.string_types:
-                endings = ('\r\n', '\r', '\\r', '\n')
-            elif isinstance(b'', content_type):  # string in python2 / bytes in python3
-                endings = (b'\r\n', b'\r', b'\\r', b'\n')
+                from charset_normalizer import from_bytes
+            except ImportError:
+                self.error('Install charset_normalizer to use it for charset detection')
+                detector = 'chardet'
             else:
-                endings = None
+                best = from_bytes(b''.join(blocks)).best()
+                return best.encoding if best else 'utf-8'
+        if detector == 'cchardet':
+            try:
+                from cchardet import UniversalDetector
+            except ImportError:
+                self.error('Install cchardet to use it for charset detection')
+                detector = 'chardet'
+        if detector == 'chardet':
+            try:
+                from chardet import UniversalDetector
+            except ImportError:
+                from chardet.universaldetector import UniversalDetector
+        sniffer = UniversalDetector()
+        for block in blocks:
+            sniffer.feed(block)
+            if sniffer.done:
+                break
+        sniffer.close()
+        return sniffer.result.get('encoding') or 'utf-8'
 
-            if endings:
-                for ending in endings:
-                    if content.find(ending) > -1:
-                        rows = content.split(ending)
+    def binary_lines(self, blocks):
+        """ Yield lines, with their endings, from blocks of bytes
+            split on any of \\r\\n, \\r or \\n
+            so that files with only \\r endings are not read as one huge line
+        """
+        tail = b''
+        for block in blocks:
+            lines = (tail + block).splitlines(True)
+            # The last line may be incomplete, or a \r split from its \n
+            tail = lines.pop()
+            for line in lines:
+                yield line
+        if tail:
+            yield tail
+
+    def decode_lines(self, lines, charset, redetect=True, count=0):
+        """ Decode lines to text - if the charset detected from the leading sample
+            fails later in the file then redetect it from the failing line on
+        """
+        lines = iter(lines)
+        for line in lines:
+            try:
+                text = line.decode(charset)
+            except UnicodeDecodeError:
+                if not redetect:
+                    raise
+                buffered = [line]
+                size = len(line)
+                for line in lines:
+                    buffered.append(line)
+                    size += len(line)
+                    if self.charset_sample_bytes and size >= self.charset_sample_bytes:
                         break
-            if not rows:
-                rows = content
+                newcharset = self.detect_charset(buffered)
+                if codecs.lookup(newcharset).name == codecs.lookup(charset).name:
+                    raise
+                self.loglist.append('Charset redetected as %s rather than %s from line %s'
+                                    % (newcharset, charset, count + 1))
+                self.charset = newcharset
+                # only allow one redetect so a mixed up file cannot keep switching
+                for text in self.decode_lines(itertools.chain(buffered, lines), newcharset,
+                                              redetect=False, count=count):
+                    yield text
+                return
+            count += 1
+            yield text
 
-        if rows:
-            for row in rows:
-                if pyversion == 3:
-                    row = row.decode(self.charset)
-                if type(row) in self.string_types:
-                    # FIXME: Works for test fixtures - but rather hacky csvreader replacement regex splitter
-                    # breaks unless empty cols have a space added!
-                    row = row.replace(',,', ', ,')
-                    row = row.replace('""', '" "')
-                    row = row.replace("''", "' '")
-                    if not row:
-                        continue
-                    row = csvsplit.split(row)
-                    row = [item for item in row if item and item not in (delimiter, '"', "'")]
-                    if pyversion == 2:
-                        try:
-                            row = [unicode(item, self.charset) for item in row]
-                        except:
-                            row = []
-                if row:
-                    count += 1
+    def text_lines(self, blocks, charset, redetect=True):
+        """ Yield decoded lines from blocks of bytes for the csv reader
+            Multibyte line endings cannot be split as bytes so transcode those to utf-8 first
+        """
+        if codecs.lookup(charset).name.startswith(('utf-16', 'utf-32')):
+            blocks = self.transcode_blocks(blocks, charset)
+            charset = 'utf-8'
+            redetect = False
+        return self.decode_lines(self.binary_lines(blocks), charset, redetect)
+
+    def transcode_blocks(self, blocks, charset):
+        """ Incrementally decode blocks from charset and encode them as utf-8 """
+        decoder = codecs.getincrementaldecoder(charset)()
+        for block in blocks:
+            yield decoder.decode(block).encode('utf-8')
+        yield decoder.decode(b'', final=True).encode('utf-8')
+
+    def raw_lines(self, blocks):
+        """ Yield raw lines from blocks of bytes, without their line endings """
+        for count, line in enumerate(self.binary_lines(blocks)):
+            content = line.rstrip(b'\r\n')
+            if not count and content == line:
+                # A single line file has no real line endings so try escaped ones
+                for content in content.split(b'\\r'):
+                    yield content
+            else:
+                yield content
+
+    def split_rows(self, blocks, delimiter=',', charset='utf-8', redetect=True):
+        """ Hacky csvreader replacement regex splitter - used when the csv library cannot
+            read the file, each line is decoded and split one at a time
+        """
+        expression = r"""(['"]*)(.*?)\1(""" + delimiter + r"""|$)"""
+        csvsplit = re.compile(expression)
+        lines = self.raw_lines(blocks)
+        if pyversion == 3:
+            lines = self.decode_lines(lines, charset, redetect)
+        for row in lines:
+            if type(row) in self.string_types:
+                # FIXME: Works for test fixtures - but rather hacky csvreader replacement regex splitter
+                # breaks unless empty cols have a space added!
+                row = row.replace(',,', ', ,')
+                row = row.replace('""', '" "')
+                row = row.replace("''", "' '")
+                if not row:
+                    continue
+                row = csvsplit.split(row)
+                row = [item for item in row if item and item not in (delimiter, '"', "'")]
+                if pyversion == 2:
                     try:
-                        output.append(row)
+                        row = [unicode(item, charset) for item in row]
                     except:
-                        self.loglist.append('Failed to parse row %s' % count)
-        return self.list_rows(output)
+                        row = []
+            if row:
+                yield row
 
     def charset_csv_reader(self, csv_data, dialect=csv.excel,
                            charset='utf-8', delimiter=',', **kwargs):
+        """ Python 3 csv reader takes the decoded text directly
+            Python 2 needs it encoded to bytes then decoded back cell by cell
+        """
+        if pyversion == 3:
+            for row in csv.reader(csv_data, dialect=dialect, delimiter=delimiter, **kwargs):
+                # skip blank lines as the fallback parser does
+                if row:
+                    yield row
+            return
         csv_reader = csv.reader(self.charset_encoder(csv_data, charset),
                                 dialect=dialect, delimiter=delimiter, **kwargs)
         for row in csv_reader:
@@ -187,21 +439,94 @@ class CSVParser(object):
         mappings = mappings.replace('column', '')
         return parse_mapping(mappings)
 
-    def check_filesystem(self, csvfile, delimiter=',', reader=True):
+    def delimiter_bytes(self):
+        """ The delimiter encoded in the charset of the file, for finding records in its bytes """
+        try:
+            return (self.delimiter or ',').encode(self.charset or 'utf-8')
+        except (LookupError, UnicodeError):
+            return (self.delimiter or ',').encode('utf-8')
+
+    def record_bounds(self, filepath, offset=0, quotechar=b'"'):
+        """ Yield the (start, end) byte offsets of the records of a file from a record boundary
+            offset, scanned from a memory map of the file by the rules the csv reader follows
+        """
+        with open(filepath, 'rb') as filehandle:
+            if offset >= os.fstat(filehandle.fileno()).st_size:
+                return
+            mapped = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for bounds in scan_records(mapped, offset, quotechar, self.delimiter_bytes()):
+                yield bounds
+        finally:
+            mapped.close()
+
+    def record_ranges(self, filepath, parts, quotechar=b'"'):
+        """ Split a file into about equal byte ranges that start and end on record boundaries,
+            so a line end in a quoted field is never used to split it
+        """
+        size = os.path.getsize(filepath)
+        targets = [size * part // parts for part in range(1, parts)]
+        starts = [0]
+        if targets:
+            for start, end in self.record_bounds(filepath, quotechar=quotechar):
+                if end >= targets[0]:
+                    if end < size:
+                        starts.append(end)
+                    while targets and targets[0] <= end:
+                        targets.pop(0)
+                    if not targets:
+                        break
+        return list(zip(starts, starts[1:] + [size]))
+
+    def read_range(self, filepath, start, end, delimiter=',', reader=True):
+        """ Parse the rows in a byte range of a file with the charset already set """
+        with open(filepath, 'rb') as filehandle:
+            filehandle.seek(start)
+            data = filehandle.read(end - start)
+        return list(self.read_rows(io.BytesIO(data), delimiter=delimiter, reader=reader))
+
+    def record_ends(self, filepath, offset=0, quotechar=b'"'):
+        """ Yield the byte offset after each record of a file from a record boundary offset.
+            Blank lines are skipped by the csv reader so they do not end a record
+        """
+        for start, end in self.record_bounds(filepath, offset, quotechar):
+            yield end
+
+    def seek_rows(self, filepath, offset, delimiter=',', reader=True):
+        """ Stream the rows of a file from a record boundary byte offset with the charset already set """
+        filehandle = open(filepath, 'rb')
+        filehandle.seek(offset)
+        return self.stream_rows(self.read_rows(filehandle, delimiter=delimiter, reader=reader, stream=True))
+
+    def stream_files(self, filepaths, delimiter=',', reader=True):
+        """ Stream the rows of each file in turn, so only one file is open at a time """
+        for filepath in filepaths:
+            rows = self.open_csvfile(filepath, delimiter=delimiter, reader=reader, stream=True)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                rows.close()
+
+    def check_filesystem(self, csvfile, delimiter=',', reader=True, stream=False):
         """ Check for files on the file system """
         if csvfile and os.path.exists(csvfile):
             if os.path.isdir(csvfile):
-                self.csvfile = []
-                for afile in os.listdir(csvfile):
-                    if afile.endswith('.csv'):
-                        filepath = os.path.join(csvfile, afile)
+                filepaths = [os.path.join(csvfile, afile) for afile in os.listdir(csvfile)
+                             if afile.endswith('.csv')]
+                if stream:
+                    self.csvfile = self.stream_files(filepaths, delimiter=delimiter, reader=reader)
+                else:
+                    self.csvfile = []
+                    for filepath in filepaths:
                         try:
                             lines = self.open_csvfile(filepath, delimiter=delimiter, reader=reader)
                             self.csvfile.extend(lines)
                         except:
                             pass
             else:
-                self.csvfile = self.open_csvfile(csvfile, delimiter=delimiter, reader=reader)
-        if not getattr(self, 'csvfile', []):
+                self.csvfile = self.open_csvfile(csvfile, delimiter=delimiter,
+                                                 reader=reader, stream=stream)
+        if not self.get_header():
             return 'File "%s" not found' % csvfile
         return ''
@@ -0,0 +1,147 @@
+""" Index of the byte offsets where the records of a csv file start, built from a memory map
+    of the file and kept in a sidecar file, so rows can be sought without parsing those before them
+"""
+import binascii
+import mmap
+import os
+from array import array
+
+from csvimport.parser import scan_records
+
+SUFFIX = '.rowindex'
+# Saved in the sidecar so an index built by other rules is rebuilt
+VERSION = 2
+
+
+class MappedRange(object):
+    """ Read only file like view of a byte range of a memory map, for the csv parser to read """
+
+    def __init__(self, mapped, start, end):
+        self.mapped = mapped
+        self.pos = start
+        self.end = end
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.end - self.pos
+        stop = min(self.pos + size, self.end)
+        data = self.mapped[self.pos:stop]
+        self.pos = stop
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RowIndex(object):
+    """ Start offsets of the records of a file, found by the quoting rules of the csv reader
+        so a line end in a quoted field does not start a record
+    """
+
+    def __init__(self, filepath, offsets=None, delimiter=b','):
+        self.filepath = filepath
+        self.delimiter = delimiter
+        stat = os.stat(filepath)
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime * 1000000)
+        self.offsets = offsets
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def open(self):
+        """ Map the file into memory, an empty file cannot be mapped """
+        if self.mapped is None and self.size:
+            with open(self.filepath, 'rb') as filehandle:
+                self.mapped = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapped
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    def build(self, quotechar=b'"'):
+        """ Scan the memory mapped file for the record starts, leaving out the blank lines
+            that the csv reader skips so the records are numbered as its rows are
+        """
+        self.offsets = array('q')
+        mapped = self.open()
+        if mapped:
+            for start, end in scan_records(mapped, 0, quotechar, self.delimiter):
+                self.offsets.append(start)
+        return self
+
+    def header(self):
+        """ The file size and modification time the index is for, and how it was built """
+        return [self.size, self.mtime, VERSION, int(binascii.hexlify(self.delimiter) or b'0', 16)]
+
+    def sidecar(self):
+        return self.filepath + SUFFIX
+
+    def load(self):
+        """ Load the offsets from the sidecar file if it was saved for this size and
+            modification time of the file, returning False if it is missing or stale
+        """
+        header = array('q')
+        expected = self.header()
+        try:
+            with open(self.sidecar(), 'rb') as filehandle:
+                header.fromfile(filehandle, len(expected))
+                if list(header) != expected:
+                    return False
+                count = (os.fstat(filehandle.fileno()).st_size // header.itemsize) - len(expected)
+                self.offsets = array('q')
+                self.offsets.fromfile(filehandle, count)
+        except (IOError, OSError, EOFError):
+            return False
+        return True
+
+    def save(self):
+        """ Save the offsets in the sidecar file, if the directory can be written to """
+        try:
+            with open(self.sidecar(), 'wb') as filehandle:
+                array('q', self.header()).tofile(filehandle)
+                self.offsets.tofile(filehandle)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def start(self, record):
+        """ Byte offset where a record starts, or the file size after the last one """
+        if record < len(self.offsets):
+            return self.offsets[record]
+        return self.size
+
+    def range(self, first=0, last=None):
+        """ Byte range of the records from first up to, not including, last """
+        if last is None:
+            last = len(self.offsets)
+        return self.start(first), self.start(max(first, last))
+
+    def ranges(self, parts):
+        """ Byte ranges of about equal numbers of records """
+        count = len(self.offsets)
+        bounds = sorted(set([count * part // parts for part in range(parts + 1)]))
+        return [self.range(first, last) for first, last in zip(bounds, bounds[1:])]
+
+    def reader(self, first=0, last=None):
+        """ File like reader of the records from first up to last from the memory map """
+        start, end = self.range(first, last)
+        return MappedRange(self.open() or b'', start, end)
+
+
+def get_row_index(filepath, delimiter=b','):
+    """ Load the index of a file from its sidecar, or build and save it """
+    index = RowIndex(filepath, delimiter=delimiter)
+    if not index.load():
+        index.build()
+        index.save()
+    return index
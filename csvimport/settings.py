@@ -82,6 +82,14 @@ DATABASES = {
     }
 }
 
+# Set to a database name to run the tests against a local PostgreSQL, eg. for the copy engine,
+# connection details are taken from the usual PGHOST, PGUSER and PGPASSWORD environment variables
+if os.environ.get("CSVIMPORT_TEST_POSTGRES"):
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ["CSVIMPORT_TEST_POSTGRES"],
+    }
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
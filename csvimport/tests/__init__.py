@@ -5,6 +5,8 @@ try:
     from csvimport.tests.optional_tests import CommandArgsTest
     from csvimport.tests.constraint_tests import ConstraintTest
     from csvimport.tests.performance_tests import PerformanceTest    
+    from csvimport.tests.engine_tests import EngineTest, EnginePragmaTest
+    from csvimport.tests.queue_tests import QueueTest, CommittedQueueTest
 except:
     # loading csvimport tests as an app to manually test the models
     # but test import for testing above breaks app startup in 1.9+
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 # Use unicode source code to make test character string writing easier
-from csvimport.tests.testcase import CommandTestCase
+from csvimport.tests.testcase import CommandTestCase, ImportCommand
 from csvimport.tests.models import Country
 import sys
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 from django.core.exceptions import ObjectDoesNotExist
 
 pyversion = sys.version_info[0]  # python 2 or 3
@@ -40,3 +44,100 @@ class ConstraintTest(CommandTestCase):
         country = self.get_country("K1")
         self.assertTrue(country.name, "Montserrat")
         Country.objects.all().delete()
+
+    def test_upsert(self, filename="countries.csv"):
+        """ Upsert the countries so changed ones are updated and missing ones created """
+        self.command(csvfile=filename, modelname="csvimport.Country", defaults="",
+                     expected_errs=["Imported 246 rows to Country"], clean=False, bulk=True)
+        Country.objects.filter(code="AF").update(name="Renamed", latitude=0)
+        Country.objects.filter(code="AX").delete()
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 1 rows to Country", "Updated 245 existing rows"],
+            clean=False,
+            upsert=True,
+            conflict_keys="code",
+            update_fields="name",
+            batch_size=100,
+        )
+        self.assertEqual(Country.objects.count(), 246)
+        country = self.get_country("AF")
+        self.assertEqual(country.name, "AFGHANISTAN")
+        self.assertEqual(country.latitude, 0)
+        self.assertEqual(self.get_country("AX").latitude, 60.15)
+
+    def test_sync(self, filename="countries.csv"):
+        """ Sync the countries so only the changed rows are written """
+        self.command(csvfile=filename, modelname="csvimport.Country", defaults="",
+                     expected_errs=["Imported 246 rows to Country"], clean=False, bulk=True)
+        Country.objects.filter(code="AF").update(name="Renamed")
+        Country.objects.filter(code="AX").delete()
+        Country.objects.create(code="ZZ", name="Nowhere")
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 0 rows to Country",
+                           "Sync inserted 1, updated 1, deleted 1 and left 244 rows unchanged"],
+            clean=False,
+            sync=True,
+            conflict_keys="code",
+            update_fields="name",
+        )
+        self.assertEqual(Country.objects.count(), 246)
+        self.assertEqual(self.get_country("AF").name, "AFGHANISTAN")
+        self.assertEqual(self.get_country("AX").latitude, 60.15)
+        self.assertFalse(Country.objects.filter(code="ZZ").exists())
+
+    def test_sync_rejected(self, filename="countries.csv"):
+        """ A line the sync rejects is not in the snapshot, so nothing missing from it is deleted """
+        self.command(csvfile=filename, modelname="csvimport.Country", defaults="",
+                     expected_errs=["Imported 246 rows to Country"], clean=False, bulk=True)
+        Country.objects.create(code="ZZ", name="Nowhere")
+        make_row = ImportCommand.make_row
+
+        def reject(cmd, row, csvimportid, index, loglist, clean=True):
+            if row[1] == "AF":
+                loglist.append("row %s: rejected" % index)
+                return None
+            return make_row(cmd, row, csvimportid, index, loglist, clean)
+
+        with mock.patch.object(ImportCommand, "make_row", reject):
+            self.command(
+                csvfile=filename,
+                modelname="csvimport.Country",
+                defaults="",
+                expected_errs=["Imported 0 rows to Country",
+                               "row 0: rejected",
+                               "Sync left 2 rows missing from the file undeleted since 1 lines were rejected",
+                               "Sync inserted 0, updated 0, deleted 0 and left 245 rows unchanged"],
+                clean=False,
+                sync=True,
+                conflict_keys="code",
+                update_fields="name",
+            )
+        self.assertEqual(Country.objects.count(), 247)
+        self.assertTrue(Country.objects.filter(code="AF").exists())
+
+    def test_bisect_bulk(self, filename="bad_country.csv"):
+        """ Bulk create the bad country file with bisect so only the failing rows are dropped """
+        errs = [
+            "row 0: line 2 could not be inserted - could not convert string to float: 'null'",
+            "row 1: line 3 could not be inserted - could not convert string to float: 'null'",
+            "row 5: line 7 could not be inserted - UNIQUE constraint failed: csvtests_country.code",
+            "Imported 3 rows to Country",
+        ]
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=errs,
+            clean=False,
+            bulk=True,
+            bisect=True,
+        )
+        self.assertEqual(Country.objects.count(), 3)
+        self.assertEqual(self.get_country("K2").name, "OKCOUNTRY2")
+        Country.objects.all().delete()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+""" Test the bulk load engines """
+import itertools
+from datetime import date
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from csvimport.engines import copy_text, get_engine
+from csvimport.management.commands.importcsv import Command as ImportCommand
+from csvimport.tests.testcase import CommandTestCase, DummyFileObj
+from csvimport.tests.models import Country, Item
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class EngineTest(CommandTestCase):
+    """ Run test of the bulk load engines """
+
+    def test_copy_text(self):
+        """ Values are escaped for the COPY text format """
+        self.assertEqual(copy_text(None), "\\N")
+        self.assertEqual(copy_text(True), "t")
+        self.assertEqual(copy_text(2.5), "2.5")
+        self.assertEqual(copy_text(u"a\tb\\c\r\nd"), u"a\\tb\\\\c\\r\\nd")
+
+    def test_copy_fallback(self, filename="countries.csv"):
+        """ The copy engine falls back to bulk create on other databases """
+        if connection.vendor == "postgresql":
+            return
+        self.assertEqual(get_engine("copy", Country), None)
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=[
+                "The copy engine does not support %s so rows are bulk created"
+                % connection.settings_dict["ENGINE"].split(".")[-1],
+                "Imported 246 rows to Country",
+            ],
+            clean=False,
+            engine="copy",
+        )
+        self.assertEqual(Country.objects.count(), 246)
+
+    @skipUnless(connection.vendor == "postgresql", "Set CSVIMPORT_TEST_POSTGRES to test COPY")
+    def test_copy(self, filename="countries.csv"):
+        """ Load the countries with COPY then upsert them through a staging table """
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 246 rows to Country"],
+            clean=False,
+            engine="copy",
+            batch_size=100,
+        )
+        self.assertEqual(Country.objects.get(code="AX").latitude, 60.15)
+        Country.objects.filter(code="AF").update(name="Renamed")
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 0 rows to Country", "Updated 246 existing rows"],
+            clean=False,
+            engine="copy",
+            upsert=True,
+            conflict_keys="code",
+            update_fields="name",
+        )
+        self.assertEqual(Country.objects.get(code="AF").name, "AFGHANISTAN")
+
+    @skipUnless(connection.vendor == "postgresql", "Set CSVIMPORT_TEST_POSTGRES to test COPY")
+    def test_copy_items(self, filename="test_plain.csv"):
+        """ Load items with foreign keys, defaults and cleaned values with COPY """
+        self.command(filename, engine="copy", expected_errs=["Imported 8 rows to Item"])
+        self.assertEqual(Item.objects.count(), 8)
+        item = self.get_item("sheeting")
+        self.assertEqual(item.organisation.name, "Save UK")
+        self.assertEqual(item.country.code, "KE")
+        Item.objects.all().delete()
+
+    @skipUnless(connection.vendor == "sqlite", "Tests the sqlite engine")
+    def test_sqlite(self, filename="countries.csv"):
+        """ Load the countries with executemany then upsert them """
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 246 rows to Country"],
+            clean=False,
+            engine="sqlite",
+            batch_size=100,
+        )
+        self.assertEqual(Country.objects.get(code="AX").latitude, 60.15)
+        Country.objects.filter(code="AF").update(name="Renamed", latitude=0)
+        Country.objects.filter(code="AX").delete()
+        self.command(
+            csvfile=filename,
+            modelname="csvimport.Country",
+            defaults="",
+            expected_errs=["Imported 1 rows to Country", "Updated 245 existing rows"],
+            clean=False,
+            engine="sqlite",
+            upsert=True,
+            conflict_keys="code",
+            update_fields="name",
+        )
+        country = Country.objects.get(code="AF")
+        self.assertEqual((country.name, country.latitude), ("AFGHANISTAN", 0))
+
+    @skipUnless(connection.vendor == "sqlite", "Tests the sqlite engine")
+    def test_sqlite_items(self, filename="test_plain.csv"):
+        """ Load items with foreign keys, defaults and cleaned values with executemany """
+        self.command(filename, engine="sqlite", expected_errs=["Imported 8 rows to Item"])
+        self.assertEqual(Item.objects.count(), 8)
+        item = self.get_item("sheeting")
+        self.assertEqual(item.organisation.name, "Save UK")
+        self.assertEqual(item.country.code, "KE")
+
+    def test_raw(self, filename="test_plain.csv"):
+        """ Raw tuples import the same values as model instances """
+        self.command(filename, bulk=True, expected_errs=["Imported 8 rows to Item"])
+        fields = ("code_share", "code_org", "organisation__name", "description",
+                  "uom__name", "quantity", "status", "country", "date", "TYPE")
+        expected = list(Item.objects.order_by("id").values_list(*fields))
+        Item.objects.all().delete()
+        for engine in ("orm", "sqlite"):
+            self.command(filename, raw=True, engine=engine, expected_errs=["Imported 8 rows to Item"])
+            self.assertEqual(list(Item.objects.order_by("id").values_list(*fields)), expected)
+            Item.objects.all().delete()
+
+    def test_raw_fresh(self, filename="test_plain.csv"):
+        """ Callable defaults are evaluated for each raw row rather than once for them all """
+        counter = itertools.count(1)
+        field = Item._meta.get_field("TYPE")
+        default = lambda: next(counter)
+        # The field caches how it gets its default
+        with mock.patch.object(field, "default", default), mock.patch.object(field, "_get_default", default):
+            self.command(filename, raw=True)
+        types = list(Item.objects.order_by("id").values_list("TYPE", flat=True))
+        self.assertEqual(types, list(range(types[0], types[0] + 8)))
+        self.assertEqual(set(Item.objects.values_list("date", flat=True)), set([date.today()]))
+        Item.objects.all().delete()
+
+    def test_raw_options(self, filename="test_plain.csv"):
+        """ Raw tuples cannot be deduplicated or upserted as there are no model instances """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        warn = cmd.setup(mappings="", modelname="csvimport.Item", charset="", uploaded=uploaded,
+                         raw=True, dedupe_keys="code_share")
+        self.assertEqual(warn, "Raw rows cannot be combined with --dedupe-keys, --upsert or --sync")
+
+
+class EnginePragmaTest(TransactionTestCase):
+    """ Outside of a test transaction so the sqlite pragmas can be set """
+
+    @skipUnless(connection.vendor == "sqlite", "Tests the sqlite engine")
+    def test_pragmas(self):
+        """ The sqlite engine sets its pragmas for the import then restores them """
+        engine = get_engine("sqlite", Country)
+
+        def pragma(name):
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA %s" % name)
+                return cursor.fetchone()[0]
+
+        before = pragma("synchronous"), pragma("cache_size")
+        with engine.load():
+            self.assertEqual(pragma("synchronous"), 0)
+            self.assertEqual(pragma("cache_size"), -65536)
+            engine.write([("ZZ", "Nowhere", 0, 0, None)])
+        self.assertEqual((pragma("synchronous"), pragma("cache_size")), before)
+        self.assertEqual(Country.objects.get(code="ZZ").name, "Nowhere")
@@ -1,6 +1,17 @@
 """ Test use of optional command line args """
-from csvimport.tests.testcase import CommandTestCase
-from csvimport.tests.models import Item
+import os
+import shutil
+import tempfile
+
+from csvimport.management.commands.importcsv import Command as ImportCommand, clean_range, import_file
+from csvimport.models import CSVImport, ImportLock
+from csvimport.tests.testcase import CommandTestCase, DummyFileObj
+from csvimport.tests.models import Country, Item
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 class CommandArgsTest(CommandTestCase):
@@ -54,3 +65,239 @@ class CommandArgsTest(CommandTestCase):
         self.assertEqual(item.quantity, 58)
         self.assertEqual(item.organisation.name, 'AID-France')
         Item.objects.all().delete()
+
+    def test_import_file(self, filename='test_plain.csv'):
+        """ A worker imports a file of a directory with its own CSVImport log record
+            and the results are summarised
+        """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        options = {'model': 'csvimport.Item', 'defaults': 'country=KE(Country|code)', 'workers': 0}
+        run = ImportCommand.run
+        held = []
+
+        def locked_run(cmd, *args, **kwargs):
+            held.extend(ImportLock.objects.values_list('name', flat=True))
+            return run(cmd, *args, **kwargs)
+
+        with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 1):
+            with mock.patch.object(ImportCommand, 'run', locked_run):
+                result = import_file((uploaded.path, options))
+        # The file held its own import slot while it ran
+        self.assertEqual(held, ['*:0'])
+        self.assertFalse(ImportLock.objects.exists())
+        self.assertEqual(result[0], uploaded.path)
+        self.assertEqual(Item.objects.count(), 8)
+        csvimport = CSVImport.objects.get(id=result[1])
+        self.assertIn('Imported 8 rows to Item', csvimport.error_log)
+        self.assertEqual(csvimport.file_name, uploaded.path)
+        self.assertTrue(csvimport.wait_seconds >= 0 and csvimport.run_seconds > 0)
+        missing = ('missing.csv', None, ['File "missing.csv" not found'])
+        summary = ImportCommand().summarise([result, missing], 2, 8)
+        self.assertEqual(summary, ['test_plain.csv: %s log lines in CSVImport %s' % (len(result[2]), result[1]),
+                                   'missing.csv: 1 log lines - File "missing.csv" not found',
+                                   'Imported 8 rows from 2 files with 2 workers'])
+        Item.objects.all().delete()
+
+    def test_sync_workers(self, filename='test_plain.csv'):
+        """ The files of a directory cannot be synced by workers, each would delete the others' rows """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        options = {'model': 'csvimport.Item', 'sync': True, 'conflict_keys': 'code_share'}
+        lines = ImportCommand().run_workers(os.path.dirname(uploaded.path), options, 2)
+        self.assertEqual(lines, ['Sync cannot be combined with --workers for a directory'])
+        self.assertEqual(Item.objects.count(), 0)
+
+    def test_clean_range(self, filename='test_number.csv'):
+        """ A worker parses and cleans a byte range of a file, leaving the header row
+            of the first range and the foreign keys for the importing process
+        """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        options = {'model': 'csvimport.Item', 'workers': 0}
+        cmd = ImportCommand()
+        cmd.charset = 'utf-8'
+        ranges = cmd.record_ranges(uploaded.path, 2)
+        rows, loglist = clean_range((uploaded.path, options, 0, ranges[0][0], ranges[0][1]))
+        self.assertEqual(rows[0][5], 'QUANTITY')
+        self.assertEqual(rows[1][5], 0)
+        self.assertEqual(rows[1][2], 'Save UK')
+        self.assertIn('Part 0: row 0: Column quantity = -23, less than zero so set to 0', loglist)
+
+    def test_parallel_file(self, filename='test_plain.csv'):
+        """ Rows of a single file parsed by workers import the same as when parsed here """
+        fields = ('code_share', 'code_org', 'organisation__name', 'quantity', 'country', 'date')
+        self.command(filename)
+        expected = list(Item.objects.order_by('id').values_list(*fields))
+        Item.objects.all().delete()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        for part_bytes in (4 * 1024 * 1024, 100):
+            # Small parts are parsed a few at a time
+            with mock.patch('csvimport.management.commands.importcsv.PART_BYTES', part_bytes):
+                cmd = ImportCommand()
+                cmd.handle_label(uploaded.path, model='csvimport.Item', defaults='country=KE(Country|code)',
+                                 workers=2)
+            self.assertEqual(list(Item.objects.order_by('id').values_list(*fields)), expected)
+            self.assertIn('Imported 8 rows to Item', cmd.loglist)
+            Item.objects.all().delete()
+
+    def test_resume(self, filename='countries.csv'):
+        """ An import that dies is resumed from the byte offset of its last committed batch """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        bulk_create = ImportCommand.bulk_create
+        calls = []
+
+        def crash(cmd, models):
+            calls.append(len(models))
+            if len(calls) == 3:
+                raise RuntimeError('Killed')
+            return bulk_create(cmd, models)
+
+        with mock.patch.object(ImportCommand, 'bulk_create', crash):
+            with self.assertRaises(RuntimeError):
+                ImportCommand().handle_label(uploaded.path, model='csvimport.Country', defaults='',
+                                             batch_size=50, checkpoint=True)
+        csvimport = CSVImport.objects.get(status='running')
+        self.assertEqual((csvimport.checkpoint_row, Country.objects.count()), (100, 100))
+        cmd = ImportCommand()
+        cmd.charset = 'utf-8'
+        rows = cmd.seek_rows(uploaded.path, csvimport.checkpoint_offset)
+        self.assertEqual(next(rows), cmd.open_csvfile(uploaded.path)[101])
+        rows.close()
+        cmd = ImportCommand()
+        cmd.handle_label(None, resume=csvimport.id, batch_size=50)
+        self.assertIn('Resumed import %s at row 100' % csvimport.id, cmd.loglist)
+        self.assertIn('Imported 146 rows to Country', cmd.loglist)
+        csvimport = CSVImport.objects.get(id=csvimport.id)
+        self.assertEqual((csvimport.status, csvimport.checkpoint_row), ('done', 246))
+        self.assertEqual(Country.objects.count(), 246)
+        self.assertEqual(ImportCommand().resume_import(csvimport.id), 'CSVImport %s is already done' % csvimport.id)
+
+    def test_resume_delimiter(self, filename='countries.csv'):
+        """ An import is resumed with its delimiter, and one whose columns cannot be
+            matched is recorded as failed rather than done
+        """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        with open(uploaded.path, 'rb') as csvfile:
+            lines = csvfile.read().split(b'\n')[:11]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'\n'.join(lines).replace(b',', b';') + b'\n')
+        os.close(handle)
+        bulk_create = ImportCommand.bulk_create
+
+        def crash(cmd, models):
+            if Country.objects.exists():
+                raise RuntimeError('Killed')
+            return bulk_create(cmd, models)
+
+        try:
+            for delimiter, status, count in ((',', 'failed', 3), (';', 'done', 10)):
+                with mock.patch.object(ImportCommand, 'bulk_create', crash):
+                    with self.assertRaises(RuntimeError):
+                        ImportCommand().handle_label(path, model='csvimport.Country', defaults='', delimiter=';',
+                                                     clean=False, batch_size=3, checkpoint=True)
+                csvimport = CSVImport.objects.get(status='running')
+                self.assertEqual((csvimport.delimiter, csvimport.clean_values), (';', False))
+                CSVImport.objects.filter(id=csvimport.id).update(delimiter=delimiter)
+                ImportCommand().handle_label(None, resume=csvimport.id, batch_size=3)
+                self.assertEqual(CSVImport.objects.get(id=csvimport.id).status, status)
+                self.assertEqual(Country.objects.count(), count)
+                Country.objects.all().delete()
+                CSVImport.objects.all().delete()
+        finally:
+            os.remove(path)
+
+    def test_resume_stray_quote(self):
+        """ A quote inside an unquoted field does not hide the record ends after it,
+            so a resumed import carries on from the row after the last batch
+        """
+        lines = [b'name,code,latitude,longitude,alias']
+        lines += [('A%s,A%s,1,2,%s" ruler' % (i, i, i)).encode('utf-8') for i in range(1, 7)]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'\n'.join(lines) + b'\n')
+        os.close(handle)
+        bulk_create = ImportCommand.bulk_create
+
+        def crash(cmd, models):
+            if Country.objects.exists():
+                raise RuntimeError('Killed')
+            return bulk_create(cmd, models)
+
+        try:
+            with mock.patch.object(ImportCommand, 'bulk_create', crash):
+                with self.assertRaises(RuntimeError):
+                    ImportCommand().handle_label(path, model='csvimport.Country', defaults='',
+                                                 batch_size=2, checkpoint=True)
+            csvimport = CSVImport.objects.get(status='running')
+            ImportCommand().handle_label(None, resume=csvimport.id, batch_size=2)
+            self.assertEqual(CSVImport.objects.get(id=csvimport.id).status, 'done')
+            self.assertEqual(sorted(Country.objects.values_list('code', flat=True)),
+                             ['A%s' % i for i in range(1, 7)])
+            self.assertEqual(Country.objects.get(code='A3').alias, '3" ruler')
+            Country.objects.all().delete()
+            CSVImport.objects.all().delete()
+        finally:
+            os.remove(path)
+
+    def test_resume_options(self, filename='test_plain.csv'):
+        """ The defaults, dedupe keys, engine and raw option the import was run with are used to resume it """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        bulk_create = ImportCommand.bulk_create
+
+        def crash(cmd, models):
+            if Item.objects.exists():
+                raise RuntimeError('Killed')
+            return bulk_create(cmd, models)
+
+        for options, count in (({'raw': True, 'engine': 'sqlite'}, 8), ({'dedupe_keys': 'code_share'}, 5)):
+            with mock.patch.object(ImportCommand, 'bulk_create', crash):
+                with self.assertRaises(RuntimeError):
+                    ImportCommand().handle_label(uploaded.path, model='csvimport.Item', batch_size=3,
+                                                 defaults='country=KE(Country|code)', checkpoint=True, **options)
+            csvimport = CSVImport.objects.get(status='running')
+            self.assertEqual(csvimport.defaults, 'country=KE(Country|code)')
+            cmd = ImportCommand()
+            cmd.handle_label(None, resume=csvimport.id, batch_size=3)
+            self.assertEqual(CSVImport.objects.get(id=csvimport.id).status, 'done')
+            self.assertEqual(Item.objects.count(), count)
+            self.assertEqual(set(Item.objects.values_list('country__code', flat=True)), set(['KE']))
+            if options.get('raw'):
+                self.assertEqual(cmd.engine.vendor, 'sqlite')
+            Item.objects.all().delete()
+
+    def test_slice(self, filename='countries.csv'):
+        """ Slices of rows import the same countries whether the rows before them
+            are parsed or sought with the row index
+        """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, filename)
+        shutil.copy(uploaded.path, path)
+        names = [row[0] for row in ImportCommand().open_csvfile(path)[1:]]
+        try:
+            for row_index in (False, True):
+                for (start_row, end_row, limit) in ((10, 0, 5), (200, 220, 0), (240, 0, 100)):
+                    cmd = ImportCommand()
+                    cmd.handle_label(path, model='csvimport.Country', defaults='', row_index=row_index,
+                                     start_row=start_row, end_row=end_row, limit=limit)
+                    expected = names[start_row:end_row or len(names)][:limit or None]
+                    self.assertEqual(sorted(Country.objects.values_list('name', flat=True)), sorted(expected))
+                    Country.objects.all().delete()
+            self.assertTrue(os.path.exists(path + '.rowindex'))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_slice_sync(self, filename='countries.csv'):
+        """ A slice of rows cannot be synced, since the rows outside it would be deleted """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        for slicing in ({'start_row': 10}, {'end_row': 20}, {'limit': 5}):
+            error = ImportCommand().setup(mappings='', modelname='csvimport.Country', charset='', defaults='',
+                                          uploaded=uploaded, sync=True, conflict_keys='code',
+                                          update_fields='name', **slicing)
+            self.assertEqual(error, 'Sync cannot be combined with --start-row, --end-row or --limit')
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 # Use unicode source code to make test character string writing easier
-from csvimport.tests.testcase import CommandTestCase
-from csvimport.tests.models import Item
+from csvimport.dedupe import BloomFilter, KeyIndex, SpillSet
+from csvimport.rowindex import RowIndex, get_row_index
+from csvimport.tests.testcase import CommandTestCase, DummyFileObj
+from csvimport.management.commands.importcsv import Command as ImportCommand
+from csvimport.tests.models import Item, Organisation, UnitOfMeasure
+import os
 import sys
+import tempfile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 pyversion = sys.version_info[0]  # python 2 or 3
 
 
@@ -23,7 +34,7 @@ class CommandParseTest(CommandTestCase):
     def test_local_parser(self, filename='test_plain.csv'):
         """ Use custom command to upload file and parse it into Items
             Use reader = False to use local parser not csv lib reader
-            Note that Python 3 csv reader is far less format tolerant so tends to use local parser
+            This is also the fallback for files the csv reader cannot parse
         """
         self.command(filename, reader=False)
         item = self.get_item('sheeting')
@@ -34,6 +45,108 @@ class CommandParseTest(CommandTestCase):
         self.assertEqual(item.organisation.name, 'Save UK')
         Item.objects.all().delete()
 
+    def test_stream(self, filename='test_plain.csv'):
+        """ Use stream = True so rows are parsed one at a time rather than read into a list """
+        self.command(filename, stream=True)
+        item = self.get_item('sheeting')
+        self.assertEqual(item.code_org, 'RF007')
+        self.assertEqual(item.description, 'Plastic sheeting, 4*60m, roll')
+        self.assertEqual(item.organisation.name, 'Save UK')
+        self.assertEqual(Item.objects.count(), 8)
+        Item.objects.all().delete()
+
+    def test_stream_rows(self, filename='test_char.csv'):
+        """ Check the streamed csvfile is a generator that still supplies the header row """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Item', charset='', uploaded=uploaded, stream=True)
+        self.assertNotIsInstance(cmd.csvfile, list)
+        self.assertEqual(cmd.header[0], 'CODE_SHARE')
+        rows = list(cmd.csvfile)
+        self.assertEqual(rows[0], cmd.header)
+        self.assertEqual(len(rows), 5)
+
+    def test_fkey_cache(self, filename='test_plain.csv'):
+        """ Check repeated foreign key values are looked up from the cache """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Item', charset='', uploaded=uploaded)
+        errors = cmd.run()
+        # 8 rows each with an organisation and unit of measure, 1 + 4 distinct values
+        self.assertEqual(cmd.fkey_hits + cmd.fkey_misses, 16)
+        self.assertTrue(cmd.fkey_hits >= 8)
+        self.assertIn('Foreign key cache hits %s, misses %s' % (cmd.fkey_hits, cmd.fkey_misses), errors)
+        self.assertEqual(self.get_item('sheeting').organisation.name, 'Save UK')
+        Item.objects.all().delete()
+        # The cache is bounded
+        cmd.fkey_cache_size = 2
+        cmd.fkey_cache.clear()
+        for value in ('a', 'b', 'c'):
+            cmd.cache_fkey(('model', 'field', value), value)
+        self.assertEqual(list(cmd.fkey_cache.keys()), [('model', 'field', 'b'), ('model', 'field', 'c')])
+
+    def test_fkey_prepass(self, filename='test_plain.csv'):
+        """ Foreign keys for the chunk are loaded and bulk created up front
+            so every lookup while making the rows is a cache hit
+        """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Item', charset='', uploaded=uploaded,
+                  fkey_prepass=True)
+        cmd.run()
+        self.assertEqual(cmd.fkey_misses, 0)
+        self.assertEqual(cmd.fkey_hits, 16)
+        self.assertEqual(Organisation.objects.filter(name='Save UK').count(), 1)
+        self.assertEqual(UnitOfMeasure.objects.count(), 4)
+        item = self.get_item('sheeting')
+        self.assertEqual(item.organisation.name, 'Save UK')
+        self.assertEqual(item.uom.name, 'Metre')
+        Item.objects.all().delete()
+
+    def test_fkey_prepass_ids(self):
+        """ Foreign key values are matched in the form of the related field, so ids
+            read as text find the existing rows rather than being created again
+        """
+        save_uk = Organisation.objects.create(name='Save UK')
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csvfile:
+            csvfile.write('bucket,WA041,%s,Set\ntent,RF024,%s,Set\n' % (save_uk.id, save_uk.id))
+        uploaded = DummyFileObj()
+        uploaded.path = path
+        try:
+            for fkey_prepass in (False, True):
+                cmd = ImportCommand()
+                cmd.setup(mappings='column1=code_share,column2=code_org,column3=organisation(Organisation|id),'
+                                   'column4=uom(UnitOfMeasure|name)',
+                          modelname='csvimport.Item', charset='', uploaded=uploaded, fkey_prepass=fkey_prepass)
+                self.assertIn('Imported 2 rows to Item', cmd.run())
+                if fkey_prepass:
+                    self.assertEqual((cmd.fkey_hits, cmd.fkey_misses), (4, 0))
+                self.assertEqual(Organisation.objects.count(), 1)
+                self.assertEqual(set(Item.objects.values_list('organisation', flat=True)), set([save_uk.id]))
+                Item.objects.all().delete()
+        finally:
+            os.remove(path)
+
+    def test_date_formats(self):
+        """ The date format found for a column is tried first for the next rows
+            with a fall back to looking again if it does not match
+        """
+        cmd = ImportCommand()
+        clean_date = cmd.make_cleaner('date', 'DateField')
+        loglist = []
+        first = clean_date('2011-08-10', loglist)
+        self.assertEqual((first.year, first.month, first.day), (2011, 8, 10))
+        self.assertEqual(clean_date(' 2012-01-31 ', loglist).month, 1)
+        self.assertEqual(clean_date('31-01-2012', loglist).day, 31)
+        self.assertEqual(clean_date('2012-02-29', loglist).day, 29)
+        self.assertEqual(clean_date('not a date', loglist), None)
+        self.assertEqual(clean_date(None, loglist), None)
+        self.assertEqual(loglist, [])
+
     def test_tab(self, filename='test_tab.csv'):
         """ Use custom command to upload file and parse it into Items with different, tab, delimiter"""
         self.command(csvfile=filename, delimiter="\t")
@@ -72,10 +185,42 @@ class CommandParseTest(CommandTestCase):
         self.assertEqual(item.organisation.name, 'AID-France')
         Item.objects.all().delete()
 
+    def test_single_open(self, filename='test_char.csv'):
+        """ Check the file is opened once for charset detection and parsing
+            and that it is closed afterwards, whether streamed or not
+        """
+        for stream in (False, True):
+            handles = []
+
+            def tracked_open(*args, **kwargs):
+                handle = open(*args, **kwargs)
+                handles.append(handle)
+                return handle
+
+            with mock.patch('csvimport.parser.open', tracked_open, create=True):
+                self.command(filename, stream=stream)
+            self.assertEqual(len(handles), 1)
+            self.assertTrue(handles[0].closed)
+            Item.objects.all().delete()
+
+    def test_charset_sample(self, filename='test_char.csv'):
+        """ Detect the charset from a small leading sample which is all ascii
+            so it has to be redetected when the unicode characters are reached
+        """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Item', charset='', uploaded=uploaded,
+                  charset_sample_bytes=64)
+        self.assertEqual(cmd.charset.lower().replace('-', ''), 'utf8')
+        self.assertEqual(cmd.csvfile[1][4], u'pi图e')
+        self.assertIn('Charset redetected as', cmd.loglist[0])
+
     def test_duplicate(self, filename='test_duplicate.csv'):
         """ Use custom command to upload file and parse it into Items """
         self.deduplicate = True
-        self.command(filename, expected_errs=['Imported 3 rows to Item'])
+        self.command(filename, expected_errs=['Imported 3 rows to Item',
+                                              'Skipped 3 rows repeated in the file'])
         items = Item.objects.all().order_by('code_share')
         self.assertEqual(len(items), 3)
         # Check a couple of the fields in Item
@@ -87,6 +232,216 @@ class CommandParseTest(CommandTestCase):
         self.assertEqual(len(items), 3 + 6)
         Item.objects.all().delete()
 
+    def test_dedupe_keys(self, filename='test_duplicate.csv'):
+        """ Deduplicate on key fields with a query per chunk and bulk create the rest """
+        self.command(filename, dedupe_keys='code_share, code_org', batch_size=2, dedupe_spill=0,
+                     expected_errs=['Imported 3 rows to Item',
+                                    'Skipped 3 duplicate rows matched on code_share, code_org'])
+        items = Item.objects.all().order_by('code_share')
+        self.assertEqual([item.code_share for item in items], [u'bucket', u'tent', u'watercan'])
+        self.assertEqual(items[0].country.code, 'KE')
+        self.command(filename, dedupe_keys='code_share', dedupe_spill=0,
+                     expected_errs=['Imported 0 rows to Item',
+                                    'Skipped 6 duplicate rows matched on code_share'])
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_existing_keys(self, filename='test_plain.csv'):
+        """ Existing rows are found by all the key fields, in the order they are given,
+            so rows that only share the first key value are not read
+        """
+        self.command(filename)
+        cmd = ImportCommand()
+        cmd.model = Item
+        fields = [Item._meta.get_field(name) for name in ('code_share', 'status')]
+        attnames = [field.attname for field in fields]
+        stock = Item.objects.get(code_share='bucket', status='Stock').pk
+        keys = [('bucket', 'Stock'), ('bucket', 'Lost'), ('tent', None)]
+        for size in (500, 2):
+            with mock.patch('csvimport.management.commands.importcsv.IN_QUERY_SIZE', size):
+                with CaptureQueriesContext(connection) as queries:
+                    existing = cmd.existing_keys(fields, attnames, keys)
+            self.assertEqual(existing, {('bucket', 'Stock'): stock})
+            self.assertEqual(len(queries), 1 if size == 500 else 3)
+        Item.objects.all().delete()
+
+    def test_dedupe_index(self, filename='test_duplicate.csv'):
+        """ Deduplicate against an in memory set or bloom filter of the keys in the table """
+        for dedupe_index in ('set', 'bloom'):
+            Item.objects.all().delete()
+            self.command(filename, dedupe_keys='code_share', dedupe_index=dedupe_index,
+                         expected_errs=['Imported 3 rows to Item',
+                                        'Skipped 3 rows repeated in the file'])
+            self.command(filename, dedupe_keys='code_share', dedupe_index=dedupe_index,
+                         expected_errs=['Imported 0 rows to Item',
+                                        'Skipped 3 rows repeated in the file',
+                                        'Skipped 3 duplicate rows matched on code_share'])
+            self.assertEqual(Item.objects.count(), 3)
+
+    def test_spill_set(self):
+        """ Repeated keys are found whether their hashes are in memory or spilled to disk """
+        seen = SpillSet(limit=10)
+        self.assertEqual([seen.add((str(i % 25),)) for i in range(50)], [True] * 25 + [False] * 25)
+        self.assertTrue(seen.db is not None)
+        self.assertTrue(len(seen.hashes) < 10)
+        seen.close()
+        # Keys whose builtin hashes collide are not taken for repeats, in memory or on disk
+        self.assertEqual(hash((-1,)), hash((-2,)))
+        for limit in (10, 1):
+            seen = SpillSet(limit=limit)
+            self.assertEqual([seen.add((-1,)), seen.add((-2,)), seen.add((-1,))], [True, True, False])
+            seen.close()
+
+    def test_key_index(self):
+        """ The set index only matches equal keys, even those whose hashes collide """
+        index = KeyIndex()
+        index.add((-1,))
+        self.assertEqual(hash((-1,)), hash((-2,)))
+        self.assertIn((-1,), index)
+        self.assertNotIn((-2,), index)
+
+    def test_bloom_filter(self):
+        """ Bloom filter has no false negatives and about its error rate of false positives """
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(100000):
+            bloom.add((str(i), i))
+        self.assertTrue(all((str(i), i) in bloom for i in range(100000)))
+        false_positives = sum(1 for i in range(100000, 200000) if (str(i), i) in bloom)
+        self.assertTrue(false_positives < 2000)
+
+    def write_records(self, rows, line_ends=(b'\r\n',), lead=b''):
+        """ Write rows to a temporary file, quoting the fields of every other row
+            and leaving stray quotes in the unquoted ones, with the line ends in turn
+        """
+        data = lead
+        for i, row in enumerate(rows):
+            if i % 2:
+                data += ','.join('"%s"' % value.replace('"', '""') for value in row).encode('utf-8')
+            else:
+                data += ','.join(row).encode('utf-8')
+            data += line_ends[i % len(line_ends)]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, data)
+        os.close(handle)
+        return path
+
+    def record_rows(self, count):
+        """ Rows with line ends in the quoted rows and stray quotes in the unquoted ones """
+        return [[str(i), 'line %s\r\nin "quotes"' % i if i % 2 else '%s" ruler' % i, 'x' * (i % 7)]
+                for i in range(count)]
+
+    def test_record_ranges(self):
+        """ Byte ranges split on record boundaries, never on a line end in a quoted field
+            nor missing one after a stray quote in an unquoted field, and parse to the same
+            rows as the whole file
+        """
+        rows = self.record_rows(200)
+        path = self.write_records(rows)
+        parser = ImportCommand()
+        parser.charset = 'utf-8'
+        try:
+            for parts in (1, 2, 3, 7, 32):
+                ranges = parser.record_ranges(path, parts)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], os.path.getsize(path))
+                parsed = []
+                for (start, end) in ranges:
+                    parsed.extend(parser.read_range(path, start, end))
+                self.assertEqual(parsed, rows)
+        finally:
+            os.remove(path)
+
+    def test_record_ends(self):
+        """ Record ends are found after each row the csv reader returns, skipping the blank lines
+            it skips, so the rows after any of them can be sought
+        """
+        rows = self.record_rows(60)
+        path = self.write_records(rows, (b'\r\n', b'\n\n', b'\r\r\n', b'\r\n\r\n\n'), lead=b'\n')
+        parser = ImportCommand()
+        parser.charset = 'utf-8'
+        try:
+            self.assertEqual(list(parser.read_range(path, 0, os.path.getsize(path))), rows)
+            ends = list(parser.record_ends(path))
+            self.assertEqual(len(ends), len(rows))
+            for count in (1, 2, 17, 59):
+                sought = parser.seek_rows(path, ends[count - 1])
+                self.assertEqual(list(sought), rows[count:])
+        finally:
+            os.remove(path)
+
+    def test_stray_quotes(self):
+        """ A quote inside an unquoted field is part of its value, as the csv reader reads it,
+            so the row index and record ends agree with the rows it returns
+        """
+        rows = [['name', 'desc', 'qty'], ['ruler', '12" steel', '1'], ['pipe', '3" copper', '2'],
+                ['nail', 'iron', '3'], ['screw', 'brass', '4']]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b''.join(','.join(row).encode('utf-8') + b'\n' for row in rows))
+        os.close(handle)
+        parser = ImportCommand()
+        parser.charset = 'utf-8'
+        try:
+            index = RowIndex(path).build()
+            self.assertEqual(len(index), 5)
+            self.assertEqual(list(parser.read_rows(index.reader(2, 4))), rows[2:4])
+            index.close()
+            self.assertEqual(len(list(parser.record_ends(path))), 5)
+        finally:
+            os.remove(path)
+
+    def test_row_index(self):
+        """ The row index finds the record starts of a memory mapped file, outside quoted
+            line ends, and is saved to a sidecar file that is rebuilt when the file changes
+        """
+        rows = [[str(i), 'line %s\nin "quotes"' % i if i % 3 else 'plain'] for i in range(100)]
+        lines = [','.join('"%s"' % value.replace('"', '""') for value in row) for row in rows]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, ('\r\n'.join(lines)).encode('utf-8'))
+        os.close(handle)
+        parser = ImportCommand()
+        parser.charset = 'utf-8'
+        try:
+            index = get_row_index(path)
+            self.assertEqual(len(index), 100)
+            self.assertEqual(list(parser.read_rows(index.reader(40, 43))), rows[40:43])
+            self.assertEqual(list(parser.read_rows(index.reader(98))), rows[98:])
+            parsed = []
+            for (start, end) in index.ranges(7):
+                parsed.extend(parser.read_range(path, start, end))
+            self.assertEqual(parsed, rows)
+            index.close()
+            self.assertTrue(os.path.exists(path + '.rowindex'))
+            saved = RowIndex(path)
+            self.assertTrue(saved.load())
+            self.assertEqual(saved.offsets, index.offsets)
+            with open(path, 'ab') as csvfile:
+                csvfile.write(b'\r\n"100","added"')
+            self.assertFalse(RowIndex(path).load())
+            self.assertEqual(len(get_row_index(path)), 101)
+        finally:
+            os.remove(path)
+            os.remove(path + '.rowindex')
+
+    def test_row_index_blank_lines(self):
+        """ Blank lines, which the csv reader skips, are not indexed as records """
+        rows = [[str(i), 'line %s\nin "quotes"' % i if i % 3 else 'plain'] for i in range(20)]
+        data = b'\r\n'
+        for i, row in enumerate(rows):
+            data += ','.join('"%s"' % value.replace('"', '""') for value in row).encode('utf-8')
+            data += (b'\n', b'\n\n', b'\r\n\r\n')[i % 3]
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, data)
+        os.close(handle)
+        parser = ImportCommand()
+        parser.charset = 'utf-8'
+        try:
+            index = RowIndex(path).build()
+            self.assertEqual(len(index), len(rows))
+            self.assertEqual(list(parser.read_rows(index.reader(5, 7))), rows[5:7])
+            self.assertEqual(list(parser.read_rows(index.reader(19))), rows[19:])
+            index.close()
+        finally:
+            os.remove(path)
+
     def test_number(self, filename='test_number.csv'):
         """ Use command to parse file with problem numeric fields
             Missing field value, negative, fractions and too big
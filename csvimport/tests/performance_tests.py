@@ -1,12 +1,102 @@
 # -*- coding: utf-8 -*-
 # Use unicode source code to make test character string writing easier
-from csvimport.tests.testcase import CommandTestCase
-from csvimport.tests.models import Country
+from csvimport.tests.testcase import CommandTestCase, DummyFileObj
+from csvimport.tests.models import Country, Item
+from csvimport.management.commands.importcsv import Command as ImportCommand
+from csvimport.management.commands.importcsv import (
+    BOOLEAN, BOOLEAN_TRUE, CSV_DATE_INPUT_FORMATS, CURRENT_TIMEZONE, DATE, INTEGER, NUMERIC, SMALLINT_DBS)
+import csv
+import os
 import sys
+import tempfile
 import timeit
+from datetime import datetime
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
 pyversion = sys.version_info[0]  # python 2 or 3
+# Set higher, eg. CSVIMPORT_BENCHMARK_ROWS=5000000, to benchmark at full scale
+BENCHMARK_ROWS = int(os.environ.get('CSVIMPORT_BENCHMARK_ROWS', 20000))
+
+
+def baseline_type_clean(self, field, value, loglist, row=0):
+    """ Copy of type_clean as it was before the cleaners were compiled, to benchmark against """
+    if not self.fieldmap.get(field):
+        raise Exception(
+            "Fieldmap is not populated for %s -\n%s" % (field, self.fieldmap)
+        )
+    field_type = self.fieldmap.get(field).get_internal_type()
+
+    try:
+        value = value.strip()
+    except AttributeError:
+        pass
+
+    # Tidy up boolean data
+    if field_type in BOOLEAN:
+        value = value in BOOLEAN_TRUE
+        # sqlite fix since it just uses int under the hood
+        if self.db_backend in SMALLINT_DBS:
+            if value:
+                value = 1
+            else:
+                value = 0
+
+    # Tidy up numeric data
+    if field_type in NUMERIC:
+        if not value:
+            value = 0
+        else:
+            try:
+                value = float(value)
+            except:
+                loglist.append(
+                    "row %s: Column %s = %s is not a number so is set to 0"
+                    % (row, field, value)
+                )
+                value = 0
+        if field_type in INTEGER:
+            # 1e+28 = 9999999999999999583119736832L
+            if value > 9223372036854775807:
+                intmsg = (
+                    "row %s: Column %s = %s more than the max integer 9223372036854775807"
+                    % (row, field, value)
+                )
+                if self.db_backend in SMALLINT_DBS:
+                    intmsg += " sqlite may error with big integers so rounded down"
+                    value = 9223372036854775807
+                loglist.append(intmsg)
+            if str(value).lower() in ("nan", "inf", "+inf", "-inf"):
+                loglist.append(
+                    "row %s: Column %s = %s is not an integer so is set to 0"
+                    % (row, field, value)
+                )
+                value = 0
+            value = int(value)
+            if value < 0 and field_type.startswith("Positive"):
+                loglist.append(
+                    "row %s: Column %s = %s, less than zero so set to 0"
+                    % (row, field, value)
+                )
+                value = 0
+    # date data - remove the date if it doesn't convert so null=True can work
+    if field_type in DATE:
+        datevalue = None
+        try:
+            datevalue = datetime(value)
+        except:
+            for datefmt in CSV_DATE_INPUT_FORMATS:
+                try:
+                    datevalue = datetime.strptime(value, datefmt)
+                except:
+                    pass
+
+        if datevalue:
+            value = timezone.make_aware(datevalue, CURRENT_TIMEZONE)
+        else:
+            # loglist.append('row %s: Column %s = %s not date format' % (i, field, value))
+            value = None
+    return value
 
 
 class PerformanceTest(CommandTestCase):
@@ -29,4 +119,121 @@ class PerformanceTest(CommandTestCase):
                      bulk=False,
                      time=True)
         self.assertTrue(single_time>bulk_time)
-        print "Time to run bulk countries import was %s faster than %s" % (bulk_time, single_time)
+        print("Time to run bulk countries import was %s faster than %s" % (bulk_time, single_time))
+
+    def test_batch_load(self, filename='countries.csv'):
+        """ Stream the country file and bulk create it in chunks of 50 rows """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Country', charset='', uploaded=uploaded,
+                  clean=False, batch_size=50, stream=True)
+        errors = cmd.run()
+        self.assertTrue(cmd.bulk)
+        self.assertEqual(cmd.chunk_count, 5)
+        self.assertEqual(Country.objects.count(), 246)
+        self.assertIn('Imported 246 rows to Country', errors)
+        self.assertTrue(errors[-2].startswith('Committed 5 chunks of up to 50 rows'))
+        Country.objects.all().delete()
+
+    def test_clean_throughput(self, filename='test_plain.csv'):
+        """ Compare cells per second cleaned by the original type_clean per cell against the compiled plan """
+        cmd = ImportCommand()
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        cmd.setup(mappings='', modelname='csvimport.Item', charset='', uploaded=uploaded)
+        cmd.mappings = cmd.set_mappings(cmd.parse_header(cmd.header))
+        plan = [(index, field, cleaner) for index, field, foreignkey, cleaner in cmd.compile_plan()
+                if not foreignkey]
+        rows = [row[:] for row in cmd.csvfile[1:]] * (BENCHMARK_ROWS // 8)
+        cells = len(rows) * len(plan)
+        loglist = []
+        timer = timeit.default_timer()
+        for i, row in enumerate(rows):
+            for index, field, cleaner in plan:
+                baseline_type_clean(cmd, field, row[index], loglist, i)
+        per_cell = cells / (timeit.default_timer() - timer)
+        timer = timeit.default_timer()
+        for i, row in enumerate(rows):
+            for index, field, cleaner in plan:
+                cleaner(row[index], loglist, i)
+        compiled = cells / (timeit.default_timer() - timer)
+        print("Cleaned %s cells at %d cells/sec with the original type_clean and %d cells/sec with the compiled plan" % (
+            cells, per_cell, compiled))
+        self.assertTrue(compiled > per_cell)
+
+    def test_date_throughput(self):
+        """ Compare dates per second parsed by trying every input format against the per column format """
+        from csvimport.management.commands.importcsv import CSV_DATE_INPUT_FORMATS
+        from datetime import datetime
+        values = ['%s-%02d-%02d' % (2000 + i % 20, i % 12 + 1, i % 28 + 1) for i in range(BENCHMARK_ROWS)]
+        timer = timeit.default_timer()
+        for value in values:
+            for datefmt in CSV_DATE_INPUT_FORMATS:
+                try:
+                    datetime.strptime(value, datefmt)
+                except ValueError:
+                    pass
+        every_format = len(values) / (timeit.default_timer() - timer)
+        clean_date = ImportCommand().make_cleaner('date', 'DateField')
+        loglist = []
+        timer = timeit.default_timer()
+        for value in values:
+            clean_date(value, loglist)
+        per_column = len(values) / (timeit.default_timer() - timer)
+        print("Parsed %s dates at %d dates/sec trying every format and %d dates/sec with the column format" % (
+            len(values), every_format, per_column))
+        self.assertTrue(per_column > every_format)
+
+    def test_raw_throughput(self, filename='test_plain.csv'):
+        """ Compare rows per second imported as model instances and as raw tuples """
+        path = self.scaled_fixture(filename)
+        rates = {}
+        try:
+            for raw in (False, True):
+                Item.objects.all().delete()
+                cmd = ImportCommand()
+                cmd.setup(mappings='', modelname='csvimport.Item', charset='utf-8', csvfile=path,
+                          defaults='country=KE(Country|code)', batch_size=5000, stream=True, raw=raw)
+                timer = timeit.default_timer()
+                cmd.run()
+                rates[raw] = BENCHMARK_ROWS / (timeit.default_timer() - timer)
+                self.assertEqual(Item.objects.count(), BENCHMARK_ROWS)
+        finally:
+            os.remove(path)
+        print("Imported %s rows at %d rows/sec as models and %d rows/sec as raw tuples" % (
+            BENCHMARK_ROWS, rates[False], rates[True]))
+        self.assertTrue(rates[True] > rates[False])
+
+    def scaled_fixture(self, filename, rows=BENCHMARK_ROWS):
+        """ Write a temporary copy of a fixture with its data rows repeated up to the number of rows """
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        lines = ImportCommand().open_csvfile(uploaded.path)
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as scaled:
+            writer = csv.writer(scaled)
+            writer.writerow(lines[0])
+            data = lines[1:]
+            for i in range(rows):
+                writer.writerow(data[i % len(data)])
+        return path
+
+    def test_reader_throughput(self, filename='test_plain.csv'):
+        """ Compare rows per second parsed by the csv library reader and the regex fallback parser """
+        path = self.scaled_fixture(filename)
+        rates = {}
+        try:
+            for reader in (True, False):
+                cmd = ImportCommand()
+                cmd.charset = 'utf-8'
+                rows = cmd.open_csvfile(path, reader=reader, stream=True)
+                timer = timeit.default_timer()
+                count = sum(1 for row in rows)
+                rates[reader] = count / (timeit.default_timer() - timer)
+                self.assertEqual(count, BENCHMARK_ROWS + 1)
+        finally:
+            os.remove(path)
+        print("Parsed %s rows at %d rows/sec with csv reader and %d rows/sec with fallback parser" % (
+            BENCHMARK_ROWS, rates[True], rates[False]))
+        self.assertTrue(rates[True] > rates[False])
@@ -0,0 +1,298 @@
+""" Test the queue of imports saved from the admin """
+import csv
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from csvimport import jobs
+from csvimport.models import CSVImport, ImportChunk, ImportLock, fs
+from csvimport.tests.testcase import CommandTestCase, DummyFileObj
+from csvimport.tests.models import Item
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class QueueTest(CommandTestCase):
+    """ Run test of queued imports """
+
+    def queue(self, filename='test_plain.csv', **kwargs):
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        kwargs.setdefault('model_name', 'csvimport.Item')
+        with mock.patch('csvimport.jobs.CSVIMPORT_QUEUE', 'worker'):
+            return jobs.enqueue(CSVImport(file_name=uploaded.path, **kwargs))
+
+    def test_claim(self):
+        """ Jobs are claimed oldest first and only once """
+        first, second = self.queue(), self.queue()
+        self.assertEqual(first.status, 'queued')
+        self.assertEqual(jobs.claim_job().id, first.id)
+        self.assertEqual(jobs.claim_job().id, second.id)
+        self.assertEqual(jobs.claim_job(), None)
+        self.assertEqual(CSVImport.objects.get(id=first.id).status, 'running')
+
+    def test_worker(self):
+        """ The worker command runs the queued job and records its log, progress and timing """
+        job = self.queue()
+        out = StringIO()
+        call_command('csvimport_worker', once=True, stdout=out)
+        job = CSVImport.objects.get(id=job.id)
+        self.assertEqual((job.status, job.progress), ('done', 8))
+        self.assertIn('Imported 8 rows to Item', job.error_log)
+        self.assertTrue(job.queued_at <= job.started_at <= job.finished_at)
+        self.assertIn('done import %s' % job.id, out.getvalue())
+        self.assertEqual(Item.objects.count(), 8)
+        Item.objects.all().delete()
+
+    def test_failed(self):
+        """ A job that cannot be imported is marked failed """
+        job = self.queue('missing.csv')
+        job = jobs.run_job(jobs.claim_job())
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(CSVImport.objects.get(id=job.id).error_log, job.error_log)
+
+    def test_fair_order(self):
+        """ Higher priorities go first, then the sources take turns starting with the least busy """
+        cron = [self.queue(upload_method='cronjob') for i in range(3)]
+        manual = [self.queue(upload_method='manual') for i in range(2)]
+        urgent = self.queue(upload_method='cronjob', priority=1)
+        CSVImport.objects.create(upload_method='cronjob', status='running')
+        ordered = jobs.fair_order(CSVImport.objects.filter(status='queued').order_by('-priority', 'queued_at', 'id'))
+        self.assertEqual([job.id for job in ordered],
+                         [urgent.id, manual[0].id, cron[0].id, manual[1].id, cron[1].id, cron[2].id])
+
+    def test_limits(self):
+        """ Jobs wait for a free slot for their model and in all, which is released when they finish """
+        first, second = self.queue(), self.queue()
+        other = self.queue(model_name='csvimport.Country')
+        with mock.patch.dict('csvimport.jobs.CSVIMPORT_MODEL_LIMITS', {'csvimport.Item': 1}):
+            with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 2):
+                claimed = jobs.claim_job(), jobs.claim_job()
+                self.assertEqual([job.id for job in claimed], [first.id, other.id])
+                self.assertEqual(ImportLock.objects.count(), 3)
+                self.assertEqual(jobs.claim_job(), None)
+                jobs.run_job(claimed[1])
+                self.assertEqual(jobs.claim_job(), None)
+                jobs.run_job(claimed[0])
+                self.assertEqual(jobs.claim_job().id, second.id)
+                with jobs.import_slots('csvimport.Country', sleep=0) as locks:
+                    self.assertEqual(sorted(lock.name for lock in locks), ['*:1'])
+        job = CSVImport.objects.get(id=first.id)
+        self.assertTrue(job.wait_seconds >= 0 and job.run_seconds > 0)
+        Item.objects.all().delete()
+
+    def test_direct_timing(self):
+        """ An import run directly records the time it waited for a slot and the time it ran """
+        uploaded = DummyFileObj()
+        uploaded.set_path('test_plain.csv')
+        ImportLock.objects.create(name='*:0')
+        sleep = time.sleep
+
+        def release(seconds):
+            ImportLock.objects.all().delete()
+            sleep(0.01)
+
+        with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 1):
+            with mock.patch('csvimport.jobs.time.sleep', release):
+                with mock.patch('sys.stdout', StringIO()):
+                    call_command('importcsv', uploaded.path, model='csvimport.Item', checkpoint=True)
+        job = CSVImport.objects.get(status='done')
+        self.assertTrue(job.wait_seconds >= 0.01 and job.run_seconds > 0)
+        self.assertEqual(Item.objects.count(), 8)
+        Item.objects.all().delete()
+
+    def test_queue_command(self):
+        """ The importcsv command can queue a file with a priority for the workers """
+        uploaded = DummyFileObj()
+        uploaded.set_path('test_plain.csv')
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('importcsv', uploaded.path, model='csvimport.Item', queue=True, priority=3)
+        job = CSVImport.objects.get(status='queued')
+        self.assertEqual((job.priority, job.upload_method, job.file_name), (3, 'cronjob', uploaded.path))
+        self.assertIn('Queued import %s' % job.id, out.getvalue())
+
+    def test_queue_options(self):
+        """ A queued import, whole or in chunks, runs with the options it was queued with """
+        uploaded = DummyFileObj()
+        uploaded.set_path('test_plain.csv')
+        with open(uploaded.path, newline='') as csvfile:
+            rows = list(csv.reader(csvfile))
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w', newline='') as csvfile:
+            csv.writer(csvfile, delimiter=';').writerows(rows)
+        options = dict(model='csvimport.Item', queue=True, delimiter=';', batch_size=3,
+                       defaults='country=KE(Country|code)', dedupe_keys='code_share')
+        try:
+            for chunks in (0, 2):
+                with mock.patch('sys.stdout', StringIO()):
+                    call_command('importcsv', path, chunks=chunks, **options)
+                job = CSVImport.objects.get(status='queued')
+                self.assertEqual((job.delimiter, job.batch_size, job.defaults, job.dedupe_keys),
+                                 (';', 3, 'country=KE(Country|code)', 'code_share'))
+                call_command('csvimport_worker', once=True, stdout=StringIO())
+                self.assertEqual(CSVImport.objects.get(id=job.id).status, 'done')
+                self.assertEqual(sorted(Item.objects.values_list('code_share', 'country__code')),
+                                 [(code, 'KE') for code in
+                                  ('bednet', 'bucket', 'sheeting', 'tent', 'watercan')])
+                Item.objects.all().delete()
+                CSVImport.objects.all().delete()
+            out = StringIO()
+            with mock.patch('sys.stdout', out):
+                call_command('importcsv', path, sync=True, conflict_keys='code_share', **options)
+            self.assertIn('Sync cannot be combined with --queue', out.getvalue())
+        finally:
+            os.remove(path)
+
+    def queue_chunks(self, parts, filename='test_plain.csv'):
+        uploaded = DummyFileObj()
+        uploaded.set_path(filename)
+        job = CSVImport(model_name='csvimport.Item', file_name=uploaded.path)
+        self.assertEqual(jobs.enqueue_chunks(job, parts), None)
+        return job
+
+    def test_chunks(self):
+        """ Workers lease the chunks of a split file and the job totals their progress and logs """
+        job = self.queue_chunks(3)
+        self.assertEqual(job.chunks, 3)
+        self.assertEqual(jobs.claim_job(), None)
+        out = StringIO()
+        call_command('csvimport_worker', once=True, name='host1', stdout=out)
+        job = CSVImport.objects.get(id=job.id)
+        self.assertEqual((job.status, job.progress), ('done', 8))
+        self.assertEqual(Item.objects.count(), 8)
+        for part in range(3):
+            self.assertIn('done part %s of import %s' % (part, job.id), out.getvalue())
+            self.assertIn('Part %s: Imported ' % part, job.error_log)
+        self.assertEqual(set(ImportChunk.objects.values_list('worker', flat=True)), set(['host1']))
+        Item.objects.all().delete()
+
+    def test_lease(self):
+        """ An abandoned lease is leased again, with the import slots it held, and the
+            first worker can no longer commit the chunk
+        """
+        job = self.queue_chunks(2)
+        with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 2):
+            first = jobs.lease_chunk('host1')
+            self.assertEqual((first.part, first.attempts), (0, 1))
+            self.assertEqual(CSVImport.objects.get(id=job.id).status, 'running')
+            self.assertEqual(jobs.lease_chunk('host2').part, 1)
+            self.assertEqual(jobs.lease_chunk('host2'), None)
+            expired = timezone.now() - timedelta(seconds=1)
+            ImportChunk.objects.filter(id=first.id).update(lease_until=expired)
+            ImportLock.objects.filter(id__in=[lock.id for lock in first.locks]).update(expires_at=expired)
+            again = jobs.lease_chunk('host2')
+            self.assertEqual((again.part, again.attempts, again.worker), (0, 2, 'host2'))
+            self.assertEqual([lock.name for lock in again.locks], [lock.name for lock in first.locks])
+        jobs.run_chunk(first)
+        self.assertEqual(Item.objects.count(), 0)
+        self.assertEqual(jobs.run_chunk(again).status, 'done')
+        self.assertTrue(Item.objects.count() > 0)
+        Item.objects.all().delete()
+
+    def test_expired_attempts(self):
+        """ A chunk whose lease runs out on its last attempt is failed, and so is its job """
+        job = self.queue_chunks(1)
+        expired = timezone.now() - timedelta(seconds=1)
+        with mock.patch('csvimport.jobs.CSVIMPORT_CHUNK_ATTEMPTS', 2):
+            for worker in ('host1', 'host2'):
+                chunk = jobs.lease_chunk(worker)
+                ImportChunk.objects.filter(id=chunk.id).update(lease_until=expired)
+            self.assertEqual(jobs.lease_chunk('host3'), None)
+        chunk = ImportChunk.objects.get(id=chunk.id)
+        self.assertEqual((chunk.status, chunk.worker, chunk.attempts), ('failed', 'host2', 2))
+        self.assertEqual(chunk.error_log, 'Part 0: Lease ran out after 2 attempts')
+        job = CSVImport.objects.get(id=job.id)
+        self.assertEqual((job.status, job.error_log), ('failed', chunk.error_log))
+
+    def test_lost_lease(self):
+        """ A chunk whose lease cannot be renewed stops importing and is queued again """
+        self.queue_chunks(1)
+        chunk = jobs.lease_chunk('host1')
+        chunk.lease_until = timezone.now()
+        with mock.patch('csvimport.jobs.renew_lease', return_value=False) as renew_lease:
+            chunk = jobs.run_chunk(chunk)
+        renew_lease.assert_called_with(chunk)
+        self.assertEqual(chunk.status, 'queued')
+        self.assertIn('Part 0 was leased to another worker', ImportChunk.objects.get(id=chunk.id).error_log)
+        self.assertEqual(Item.objects.count(), 0)
+
+
+class CommittedQueueTest(TransactionTestCase):
+    """ Test the queue where other threads must see the committed jobs """
+
+    def test_admin_save(self):
+        """ The thread pool is only given the job once the admin's transaction has committed """
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        submitted = []
+        executor = mock.Mock()
+        executor.submit.side_effect = lambda func: submitted.append((func, connection.in_atomic_block))
+        tempdir = tempfile.mkdtemp()
+        try:
+            with mock.patch('csvimport.jobs.CSVIMPORT_QUEUE', 'thread'), \
+                    mock.patch('csvimport.jobs.executor', executor), \
+                    mock.patch.object(fs, 'location', tempdir):
+                response = self.client.post('/admin/csvimport/csvimport/add/', {
+                    'model_name': 'csvimport.Item',
+                    'upload_file': SimpleUploadedFile('test_plain.csv', b'code_share\nsheeting\n'),
+                    'priority': 0,
+                    'upload_method': 'manual',
+                })
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(submitted, [(jobs.run_queued, False)])
+        self.assertEqual(CSVImport.objects.get().status, 'queued')
+
+    def test_renew_lease(self):
+        """ A worker renews the lease of its chunk until another worker has leased it """
+        uploaded = DummyFileObj()
+        uploaded.set_path('test_plain.csv')
+        jobs.enqueue_chunks(CSVImport(model_name='csvimport.Item', file_name=uploaded.path), 1)
+        with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 2):
+            chunk = jobs.lease_chunk('host1')
+        expired = timezone.now() - timedelta(seconds=1)
+        ImportChunk.objects.filter(id=chunk.id).update(lease_until=expired)
+        self.assertTrue(jobs.renew_lease(chunk))
+        self.assertTrue(ImportChunk.objects.get(id=chunk.id).lease_until > timezone.now())
+        self.assertEqual(ImportChunk.objects.get(id=chunk.id).lease_until, chunk.lease_until)
+        self.assertEqual(set(ImportLock.objects.values_list('expires_at', flat=True)), set([chunk.lease_until]))
+        ImportChunk.objects.filter(id=chunk.id).update(lease_until=expired)
+        self.assertEqual(jobs.lease_chunk('host2').attempts, 2)
+        self.assertFalse(jobs.renew_lease(chunk))
+
+    def test_thread_waits(self):
+        """ A thread that finds the import slots busy polls until they are free rather than
+            leaving the job queued
+        """
+        uploaded = DummyFileObj()
+        uploaded.set_path('test_plain.csv')
+        with mock.patch('csvimport.jobs.CSVIMPORT_QUEUE', 'worker'):
+            job = jobs.enqueue(CSVImport(model_name='csvimport.Item', file_name=uploaded.path))
+        ImportLock.objects.create(name='*:0')
+        slept = []
+
+        def release(seconds):
+            slept.append(seconds)
+            ImportLock.objects.all().delete()
+
+        with mock.patch('csvimport.jobs.CSVIMPORT_MAX_IMPORTS', 1):
+            with mock.patch('csvimport.jobs.time.sleep', release):
+                jobs.run_queued(sleep=2)
+        self.assertEqual(slept, [2])
+        self.assertEqual(CSVImport.objects.get(id=job.id).status, 'done')
+        self.assertEqual(Item.objects.count(), 8)